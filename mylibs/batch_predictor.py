@@ -0,0 +1,34 @@
+__author__ = "Juri Bieler"
+__version__ = "0.0.1"
+__email__ = "juribieler@gmail.com"
+__status__ = "Development"
+
+# ==============================================================================
+# description     :shared single point / batch prediction of the surrogate models
+# date            :2018-07-23
+# version         :0.01
+# notes           :
+# python_version  :3.6
+# ==============================================================================
+
+import numpy as np
+
+# number of points predict_batch evaluates at once
+PREDICT_CHUNK = 1000
+
+
+class BatchPredictor:
+    """
+    mixin for surrogates with a predict_batch(x_pred) method and the number of inputs in self._k
+    """
+
+    def predict(self, x_pred):
+        """
+        predicts a value from the surrogate model
+        :param x_pred: vector of input values (or a matrix with one point per row, see predict_batch)
+        :return: result value (or array of result values)
+        """
+        x_pred = np.asarray(x_pred, dtype=float)
+        if x_pred.ndim > 1:
+            return self.predict_batch(x_pred)
+        return self.predict_batch(x_pred.reshape((1, self._k)))[0].item()
@@ -0,0 +1,258 @@
+__author__ = "Juri Bieler"
+__version__ = "0.0.1"
+__email__ = "juribieler@gmail.com"
+__status__ = "Development"
+
+# ==============================================================================
+# description     :n-dimensional Kriging with a matrix free (conjugate gradient) solver for large sample counts
+# date            :2018-07-23
+# version         :0.01
+# notes           :
+# python_version  :3.6
+# ==============================================================================
+
+from mylibs.kriging_base import KrigingBase
+from mylibs.sparse_kriging import calc_cormat
+
+import numpy as np
+from scipy.linalg import lapack
+from scipy.linalg import cho_solve
+from scipy.linalg import solve_triangular
+
+VERBOSE = False
+# max number of entries of the distance block (rows x n x k) that is built at once in a matrix vector product
+BLOCK_ENTRIES = 2 ** 22
+# number of points per block of the block jacobi preconditioner (smaller blocks leave too many tiny eigenvalues of
+# R to the conjugate gradients and lanczos steps for p = 2)
+PRECOND_BLOCK = 1024
+# relative residual of the conjugate gradient solves during the hyperparameter search
+SEARCH_TOL = 1e-3
+
+
+class CGKriging(KrigingBase):
+
+    def __init__(self, known_in, known_val, tol=1e-4, max_iter=1000, probes=16, lanczos_steps=50, nugget=1e-9, seed=0,
+                 search_tol=SEARCH_TOL):
+        """
+        Kriging that never builds the n x n correlation matrix, the systems are solved by preconditioned conjugate
+        gradients with blockwise matrix vector products and ln|R| is estimated by stochastic lanczos quadrature
+        :param known_in: list of lists with input sample points
+        :param known_val: list of results for the known_in
+        :param tol: relative residual of the conjugate gradient solves of the final model
+        :param max_iter: maximum number of conjugate gradient iterations
+        :param probes: number of random probe vectors of the log determinant estimation
+        :param lanczos_steps: number of lanczos steps per probe vector
+        :param nugget: nugget * n is added to the diagonal of R, bounds its condition number and so the number of
+        iterations (like the cholesky retry of Kriging the nugget grows with n)
+        :param seed: seed of the probe vectors (they stay fixed, so the likelihood is a smooth function of the parameters)
+        :param search_tol: relative residual of the solves during the hyperparameter search
+        """
+        KrigingBase.__init__(self, known_in, known_val)
+        self.tol = tol
+        self.search_tol = search_tol
+        self.max_iter = max_iter
+        self.lanczos_steps = lanczos_steps
+        self._nugget = nugget * self._n
+        self._tol = tol
+        # rademacher probe vectors of the log determinant estimation
+        self._probes = np.random.default_rng(seed).choice([-1., 1.], size=(self._n, probes))
+        # blocks of neighbouring points for the preconditioner
+        self._precond_blocks = spatial_blocks(self._known_in, PRECOND_BLOCK)
+        self._precond_chol = None
+        # R^-1 (y - 1 * mu), the weights of the correlation vector in predict
+        self._weights = None
+        # last solution of R^-1 @ [1, y], start value of the next solve
+        self._inv_rhs = None
+        # number of conjugate gradient iterations of the last solve
+        self.cg_iter = 0
+        # False if the last solve did not reach the tolerance, its likelihood is not used then
+        self._converged = False
+        # True during the hyperparameter search
+        self._searching = False
+
+    def _calc_model(self):
+        """
+        solves R @ [1, y] and estimates ln|R|, then calculates mu, sigma^2 and the weights
+        :return: True if no errors
+        """
+        self._mu = None
+        self._weights = None
+        self._converged = False
+        if not self._calc_precond():
+            if VERBOSE:
+                print('ERROR: could not factorize the preconditioner')
+            return False
+        one = np.ones((self._n, 1)).flatten()
+        self._inv_rhs, self._converged = self.solve(np.column_stack((one, self._known_val)), x0=self._inv_rhs)
+        if not self._converged and (VERBOSE or not self._searching):
+            print('WARNING: conjugate gradients did not converge to {:g} in {:d} iterations (theta: {:s}, p: {:s})'
+                  .format(self._tol, self.cg_iter, str(self._theta), str(self._p)))
+        inv_one, inv_val = self._inv_rhs.T
+        self._mu = np.sum(inv_val) / np.sum(inv_one)
+        self._weights = inv_val - self._mu * inv_one
+        self._sigma_sqr = ((self._known_val - one * self._mu) @ self._weights) / self._n
+        self._ln_det_cor_mat = self.estimate_ln_det()
+        return True
+
+    def _calc_precond(self):
+        """
+        cholesky factors of the diagonal blocks of R (block jacobi preconditioner)
+        :return: True if all blocks could be factorized
+        """
+        self._precond_chol = []
+        for block in self._precond_blocks:
+            cor_block = calc_cormat(self._known_in[block], self._known_in[block], self._theta, self._p)
+            cor_block[np.diag_indices_from(cor_block)] += self._nugget
+            chol, info = lapack.dpotrf(cor_block, lower=1, clean=1)
+            if info != 0:
+                self._precond_chol = None
+                return False
+            self._precond_chol.append(chol)
+        return True
+
+    def _precond(self, res):
+        """
+        :param res: matrix of residuals (n x r)
+        :return: block jacobi preconditioned residuals
+        """
+        out = np.empty_like(res)
+        for block, chol in zip(self._precond_blocks, self._precond_chol):
+            out[block] = cho_solve((chol, True), res[block], check_finite=False)
+        return out
+
+    def matvec(self, vec):
+        """
+        (R + nugget * I) @ vec, R is built in blocks of rows and never stored
+        :param vec: matrix (n x r)
+        :return: matrix (n x r)
+        """
+        out = np.empty_like(vec)
+        rows = max(1, BLOCK_ENTRIES // (self._n * self._k))
+        for i in range(0, self._n, rows):
+            out[i:i + rows] = calc_cormat(self._known_in[i:i + rows], self._known_in, self._theta, self._p) @ vec
+        return out + self._nugget * vec
+
+    def solve(self, rhs, x0=None):
+        """
+        preconditioned conjugate gradients for all columns of rhs at once
+        :param rhs: matrix of right hand sides (n x r)
+        :param x0: optional start value
+        :return: (R^-1 @ rhs, True if all columns converged)
+        """
+        x = np.zeros_like(rhs) if x0 is None else x0.copy()
+        res = rhs - self.matvec(x) if x0 is not None else rhs.copy()
+        z = self._precond(res)
+        direc = z.copy()
+        res_z = np.sum(res * z, axis=0)
+        rhs_norm = np.linalg.norm(rhs, axis=0)
+        self.cg_iter = 0
+        for i in range(0, self.max_iter):
+            active = np.linalg.norm(res, axis=0) > self._tol * rhs_norm
+            if not active.any():
+                return x, True
+            self.cg_iter += 1
+            r_direc = self.matvec(direc)
+            alpha = np.where(active, res_z / np.sum(direc * r_direc, axis=0), 0.)
+            x += alpha * direc
+            res -= alpha * r_direc
+            z = self._precond(res)
+            res_z_new = np.sum(res * z, axis=0)
+            direc = z + np.where(active, res_z_new / res_z, 0.) * direc
+            res_z = res_z_new
+        return x, bool(np.all(np.linalg.norm(res, axis=0) <= self._tol * rhs_norm))
+
+    def _chol_solve(self, vec, trans):
+        """
+        :param vec: matrix (n x r)
+        :param trans: 0 for L^-1 @ vec, 1 for L^-T @ vec with L the block diagonal cholesky factor of the preconditioner
+        :return: matrix (n x r)
+        """
+        out = np.empty_like(vec)
+        for block, chol in zip(self._precond_blocks, self._precond_chol):
+            out[block] = solve_triangular(chol, vec[block], trans=trans, lower=True, check_finite=False)
+        return out
+
+    def estimate_ln_det(self):
+        """
+        stochastic lanczos quadrature on the preconditioned matrix L^-1 R L^-T: z^T ln(L^-1 R L^-T) z is approximated
+        by gauss quadrature on the lanczos tridiagonal matrix of every probe vector z, their mean is the trace,
+        ln|R| = ln|L L^T| + trace(ln(L^-1 R L^-T)) (the blocks hold most of the tiny eigenvalues of R, so they
+        are not left to the few lanczos steps)
+        :return: estimated ln|R|
+        """
+        probes = self._probes.shape[1]
+        steps = min(self.lanczos_steps, self._n)
+        alphas = np.zeros((steps, probes))
+        betas = np.zeros((steps, probes))
+        q = self._probes / np.sqrt(self._n)
+        q_prev = np.zeros_like(q)
+        beta = np.zeros(probes)
+        for j in range(0, steps):
+            w = self._chol_solve(self.matvec(self._chol_solve(q, 1)), 0) - beta * q_prev
+            alphas[j] = np.sum(q * w, axis=0)
+            w -= alphas[j] * q
+            beta = np.linalg.norm(w, axis=0)
+            betas[j] = beta
+            # a vanishing beta means the krylov space is exhausted, the remaining steps get decoupled
+            q_prev, q = q, w / np.where(beta > 1e-12, beta, np.inf)
+        ln_det = 0.
+        for i in range(0, probes):
+            tri = np.diag(alphas[:, i]) + np.diag(betas[:-1, i], 1) + np.diag(betas[:-1, i], -1)
+            eig_val, eig_vec = np.linalg.eigh(tri)
+            ln_det += np.sum(eig_vec[0] ** 2 * np.log(np.maximum(eig_val, 1e-300)))
+        ln_det_precond = 2. * sum(np.sum(np.log(np.diag(chol))) for chol in self._precond_chol)
+        return ln_det_precond + self._n * ln_det / probes
+
+    def calc_likelihood(self):
+        """
+        calculates the negative logarithmic likelihood
+        :return: negative logarithmic likelihood (or infinity if an error appears or the solve did not converge)
+        """
+        if not self._converged:
+            return float('inf')
+        return KrigingBase.calc_likelihood(self)
+
+    def _find_params(self, opti_algo, seed, workers, budget):
+        # the search only needs rough solves, the final model uses tol
+        self._tol = max(self.search_tol, self.tol)
+        self._searching = True
+        try:
+            return KrigingBase._find_params(self, opti_algo, seed, workers, budget)
+        finally:
+            self._tol = self.tol
+            self._searching = False
+
+    def predict_batch(self, x_pred):
+        """
+        predicts the values of many points at once, in chunks that fit the block size of the matrix vector products
+        :param x_pred: matrix of input values
+        :return: array of result values
+        """
+        self._check_model()
+        x_pred = np.asarray(x_pred, dtype=float).reshape((-1, self._k))
+        fx = np.empty(x_pred.shape[0])
+        rows = max(1, BLOCK_ENTRIES // (self._n * self._k))
+        for i in range(0, x_pred.shape[0], rows):
+            fx[i:i + rows] = self._mu + calc_cormat(x_pred[i:i + rows], self._known_in, self._theta, self._p) @ self._weights
+        return fx
+
+
+def spatial_blocks(known_in, size):
+    """
+    splits the points recursively at the median of their widest input until every block has at most size points
+    :param known_in: matrix of sample points
+    :param size: maximum number of points per block
+    :return: list of index arrays
+    """
+    blocks = []
+    stack = [np.arange(known_in.shape[0])]
+    while len(stack) > 0:
+        indices = stack.pop()
+        if len(indices) <= size:
+            blocks.append(indices)
+            continue
+        pts = known_in[indices]
+        d = int(np.argmax(pts.max(axis=0) - pts.min(axis=0)))
+        order = indices[np.argsort(pts[:, d], kind='stable')]
+        stack += [order[:len(order) // 2], order[len(order) // 2:]]
+    return blocks
@@ -0,0 +1,157 @@
+__author__ = "Juri Bieler"
+__version__ = "0.0.1"
+__email__ = "juribieler@gmail.com"
+__status__ = "Development"
+
+# ==============================================================================
+# description     :n-dimensional Kriging for full factorial (tensor grid) samples using kronecker algebra
+# date            :2018-07-23
+# version         :0.01
+# notes           :
+# python_version  :3.6
+# ==============================================================================
+
+from mylibs.batch_predictor import PREDICT_CHUNK
+from mylibs.kriging_base import KrigingBase
+
+import numpy as np
+
+VERBOSE = False
+# relative nugget that gets added to the diagonal if the correlation matrix is numerically singular
+NUGGET = 1e-12
+# eigenvalues of the correlation matrix below EIG_TOL times the largest one count as numerically zero
+EIG_TOL = np.finfo(float).eps
+
+
+class GridKriging(KrigingBase):
+    # the likelihood of a grid is cheap, so the full grid search is the default
+    default_opti_algo = 'grid'
+
+    def __init__(self, known_in, known_val):
+        """
+        on a tensor grid the kriging correlation matrix is the kronecker product of one small matrix per axis,
+        only these get factorized (eigen decomposition), so a grid with n points trains in O(sum n_d^3 + n * sum n_d)
+        :param known_in: list of lists with input sample points, they have to form a full tensor grid (any order)
+        :param known_val: list of results for the known_in
+        """
+        KrigingBase.__init__(self, known_in, known_val)
+        grid = detect_grid(self._known_in)
+        if grid is None:
+            raise Exception('ERROR: the sample points of GridKriging have to form a full tensor grid')
+        self._axes, lin_index = grid
+        self._shape = tuple([len(a) for a in self._axes])
+        # the results as tensor, axis d belongs to input d
+        self._val_grid = np.zeros(self._shape).flatten()
+        self._val_grid[lin_index] = self._known_val
+        self._val_grid = self._val_grid.reshape(self._shape)
+        # eigen decomposition (vectors, values) of the correlation matrix of every axis
+        self._eig_vec = None
+        self._eig_val = None
+        # eigenvalues of the full correlation matrix as tensor
+        self._eig_grid = None
+        # R^-1 (y - 1 * mu) as tensor, the weights of the correlation vector in predict
+        self._weights = None
+
+    @staticmethod
+    def from_grid(axes, values):
+        """
+        :param axes: list with the grid values of every input
+        :param values: tensor of results (axis d belongs to input d)
+        :return: GridKriging instance
+        """
+        mesh = np.meshgrid(*axes, indexing='ij')
+        known_in = np.array([m.flatten() for m in mesh]).T
+        return GridKriging(known_in, np.array(values).flatten())
+
+    def _calc_model(self):
+        """
+        factorizes the per axis correlation matrices and calculates mu, sigma^2 and the weights
+        :return: None
+        """
+        self._mu = None
+        self._weights = None
+        self._eig_vec = []
+        self._eig_val = []
+        for d in range(0, self._k):
+            dist = np.abs(self._axes[d][:, np.newaxis] - self._axes[d][np.newaxis, :])
+            eig_val, eig_vec = np.linalg.eigh(np.exp(-self._theta[d] * dist ** self._p[d]))
+            # the axis matrices are positive semi definite, negative eigenvalues are rounding errors
+            self._eig_val.append(np.maximum(eig_val, 0.))
+            self._eig_vec.append(eig_vec)
+        # eigenvalues of the kronecker product are all products of the axis eigenvalues
+        eig_grid = self._eig_val[0]
+        for d in range(1, self._k):
+            eig_grid = np.multiply.outer(eig_grid, self._eig_val[d])
+        # eigenvalues below the rounding error of the largest one are noise, like the cholesky factorization of the
+        # dense Kriging fails for such a matrix, it gets the same nugget
+        if np.min(eig_grid) <= EIG_TOL * np.max(eig_grid):
+            if VERBOSE:
+                print('WARNING: correlation matrix numerically singular, adding nugget')
+            eig_grid = eig_grid + NUGGET * self._n
+        self._eig_grid = eig_grid
+        self._ln_det_cor_mat = np.sum(np.log(eig_grid))
+        inv_one = self._solve(np.ones(self._shape))
+        inv_val = self._solve(self._val_grid)
+        self._mu = np.sum(inv_val) / np.sum(inv_one)
+        self._weights = inv_val - self._mu * inv_one
+        self._sigma_sqr = np.sum((self._val_grid - self._mu) * self._weights) / self._n
+
+    def _solve(self, grid):
+        """
+        :param grid: tensor with the grid shape
+        :return: R^-1 @ grid with R = kron(R_1, ..., R_k)
+        """
+        res = kron_apply([v.T for v in self._eig_vec], grid)
+        return kron_apply(self._eig_vec, res / self._eig_grid)
+
+    def predict_batch(self, x_pred, chunk_size=PREDICT_CHUNK):
+        """
+        predicts the values of many points at once, the correlation vector of a point is the kronecker product
+        of its per axis correlations, so the weights get contracted one axis after the other
+        :param x_pred: matrix of input values
+        :param chunk_size: number of points per chunk
+        :return: array of result values
+        """
+        self._check_model()
+        x_pred = np.asarray(x_pred, dtype=float).reshape((-1, self._k))
+        fx = np.empty(x_pred.shape[0])
+        for i in range(0, x_pred.shape[0], chunk_size):
+            chunk = x_pred[i:i + chunk_size]
+            m = chunk.shape[0]
+            res = None
+            for d in range(0, self._k):
+                psi_d = np.exp(-self._theta[d] * np.abs(chunk[:, d][:, np.newaxis] - self._axes[d][np.newaxis, :]) ** self._p[d])
+                if res is None:
+                    res = psi_d @ self._weights.reshape((self._shape[0], -1))
+                else:
+                    res = np.einsum('mir,mi->mr', res.reshape((m, self._shape[d], -1)), psi_d)
+            fx[i:i + chunk_size] = self._mu + res.reshape(m)
+        return fx
+
+
+def kron_apply(mats, grid):
+    """
+    :param mats: list of matrices, one for every axis of grid
+    :param grid: tensor
+    :return: kron(mats[0], ..., mats[-1]) @ grid.flatten() in the shape of grid
+    """
+    for d in range(0, len(mats)):
+        grid = np.moveaxis(np.tensordot(mats[d], grid, axes=(1, d)), 0, d)
+    return grid
+
+
+def detect_grid(known_in):
+    """
+    checks if the points form a full tensor grid
+    :param known_in: matrix of sample points
+    :return: (list of the sorted grid values of every axis, linear grid index of every point) or None if it is no grid
+    """
+    axes = [np.unique(known_in[:, d]) for d in range(0, known_in.shape[1])]
+    shape = tuple([len(a) for a in axes])
+    if int(np.prod(shape)) != known_in.shape[0]:
+        return None
+    index = [np.searchsorted(axes[d], known_in[:, d]) for d in range(0, known_in.shape[1])]
+    lin_index = np.ravel_multi_index(index, shape)
+    if len(np.unique(lin_index)) != known_in.shape[0]:
+        return None
+    return axes, lin_index
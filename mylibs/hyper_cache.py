@@ -0,0 +1,105 @@
+__author__ = "Juri Bieler"
+__version__ = "0.0.1"
+__email__ = "juribieler@gmail.com"
+__status__ = "Development"
+
+# ==============================================================================
+# description     :on-disk cache of optimized Kriging hyperparameters with warm starts from similar data sets
+# date            :2018-07-23
+# version         :0.01
+# notes           :
+# python_version  :3.6
+# ==============================================================================
+
+import hashlib
+import json
+import os
+
+import numpy as np
+
+# max feature distance of a cached data set to be used as warm start
+WARM_START_DIST = 0.5
+
+
+class HyperCache:
+
+    def __init__(self, file_path, warm_start_dist=WARM_START_DIST):
+        """
+        the optimized parameters get stored per data set (hash of samples, results and scaling), data sets without
+        an entry get the parameters of the most similar cached data set as start value of a local search
+        :param file_path: path of the json file the cache is stored in (created on the first store)
+        :param warm_start_dist: max feature distance for a warm start (see calc_features)
+        """
+        self.file_path = file_path
+        self.warm_start_dist = warm_start_dist
+        self._entries = {}
+        if os.path.isfile(file_path):
+            with open(file_path, 'r') as cache_f:
+                self._entries = json.load(cache_f)
+
+    def lookup(self, known_in, known_val, scaling=None):
+        """
+        :param known_in: matrix of input sample points
+        :param known_val: list of results for the known_in
+        :param scaling: optional list of scaling values (offsets, factors) the samples were scaled with
+        :return: (parameters [log10(theta), p], True if the data set itself is cached) or (None, False)
+        """
+        key = calc_key(known_in, known_val, scaling)
+        if key in self._entries:
+            return np.array(self._entries[key]['params']), True
+        features = calc_features(known_in, known_val)
+        best_params = None
+        best_dist = self.warm_start_dist
+        for entry in self._entries.values():
+            if len(entry['features']) != len(features):
+                continue
+            dist = np.linalg.norm(np.array(entry['features']) - features)
+            if dist <= best_dist:
+                best_dist = dist
+                best_params = np.array(entry['params'])
+        return best_params, False
+
+    def store(self, known_in, known_val, params, likelihood, scaling=None):
+        """
+        adds the optimized parameters of a data set and writes the cache file
+        :param known_in: matrix of input sample points
+        :param known_val: list of results for the known_in
+        :param params: optimized parameters [log10(theta), p]
+        :param likelihood: negative log likelihood at params
+        :param scaling: optional list of scaling values (offsets, factors) the samples were scaled with
+        :return: None
+        """
+        self._entries[calc_key(known_in, known_val, scaling)] = {
+            'params': [float(v) for v in params],
+            'likelihood': float(likelihood),
+            'features': [float(v) for v in calc_features(known_in, known_val)]}
+        with open(self.file_path, 'w') as cache_f:
+            json.dump(self._entries, cache_f, indent=1)
+
+
+def calc_key(known_in, known_val, scaling=None):
+    """
+    :return: hash of the data set (sample points, results and scaling)
+    """
+    sha = hashlib.sha1()
+    sha.update(np.ascontiguousarray(known_in, dtype=float).tobytes())
+    sha.update(np.ascontiguousarray(known_val, dtype=float).tobytes())
+    if scaling is not None:
+        sha.update(np.ascontiguousarray(scaling, dtype=float).tobytes())
+    return sha.hexdigest()
+
+
+def calc_features(known_in, known_val):
+    """
+    scale free description of a data set for the similarity search:
+    ln of the sample count, input range relative to its center and the coefficient of variation of the results
+    :return: feature vector (its length depends on the number of inputs)
+    """
+    known_in = np.array(known_in, dtype=float).reshape((len(known_val), -1))
+    known_val = np.array(known_val, dtype=float).flatten()
+    in_min = known_in.min(axis=0)
+    in_max = known_in.max(axis=0)
+    in_scale = np.maximum(np.abs(in_max) + np.abs(in_min), 1e-12)
+    val_scale = max(abs(np.mean(known_val)), 1e-12)
+    return np.concatenate(([np.log(len(known_val))], in_min / in_scale, in_max / in_scale,
+                           [np.std(known_val) / val_scale]))
@@ -19,28 +19,47 @@ __status__ = "Development"
 'cubic': r**3
 'quintic': r**5
 'thin_plate': r**2 * log(r)
+the names of scipy.interpolate.RBFInterpolator (e.g. 'thin_plate_spline') work too
+like the legacy Rbf the multiquadric, inverse and gaussian kernels get no polynomial tail, the other kernels need the
+default tail of RBFInterpolator (so they differ slightly from the legacy Rbf)
 '''
 
-from scipy.interpolate import Rbf
+from scipy.interpolate import RBFInterpolator
 import numpy as np
 
+from mylibs.batch_predictor import BatchPredictor
+from mylibs.batch_predictor import PREDICT_CHUNK
 
-class RBFscipy:
+# names of the legacy scipy Rbf functions and their RBFInterpolator kernels
+KERNEL_NAMES = {'multiquadric': 'multiquadric',
+                'inverse': 'inverse_multiquadric',
+                'gaussian': 'gaussian',
+                'linear': 'linear',
+                'cubic': 'cubic',
+                'quintic': 'quintic',
+                'thin_plate': 'thin_plate_spline'}
+# kernels that are fitted without polynomial tail (as the legacy Rbf does)
+NO_TAIL_KERNELS = ('multiquadric', 'inverse_multiquadric', 'inverse_quadratic', 'gaussian')
 
-    def __init__(self, known_in, known_val):
+
+class RBFscipy(BatchPredictor):
+
+    def __init__(self, known_in, known_val, neighbors=None):
         """
         :param known_in: list of lists with input sample points
         :param known_val: list of results for the known_in
+        :param neighbors: if set every prediction only uses this many nearest centers (for large sample counts)
         """
-        self._known_in = np.array(known_in.copy())
-        self._known_val = np.array(known_val.copy())
+        self._known_in = np.array(known_in, dtype=float)
+        self._known_val = np.array(known_val, dtype=float).flatten()
+        if len(self._known_in.shape) == 1:
+            self._known_in = self._known_in.reshape((self._known_in.shape[0], 1))
         self._k = self._known_in.shape[1]
         self._n = self._known_in.shape[0]
+        self._neighbors = None if neighbors is None else min(int(neighbors), self._n)
         self._rbf = 'linear'
         self._rbf_const = 1.
         self._f = None
-        self._offsets = np.zeros((self._k))
-        self._scalers = np.zeros((self._k))
 
     def train(self):
         pass
@@ -51,23 +70,30 @@ class RBFscipy:
         self.calc_rbf()
 
     def calc_rbf(self):
-        if self._k == 1:
-            self._f = Rbf(self._known_in[:,0], self._known_val, function=self._rbf, epsilon=self._rbf_const)
-        elif self._k == 2:
-            self._f = Rbf(self._known_in[:,0], self._known_in[:,1], self._known_val, function=self._rbf, epsilon=self._rbf_const)
-        elif self._k == 3:
-            self._f = Rbf(self._known_in[:,0], self._known_in[:,1], self._known_in[:,2], self._known_val, function=self._rbf, epsilon=self._rbf_const)
+        # the legacy Rbf scales r by 1/epsilon, RBFInterpolator by epsilon
+        kernel = KERNEL_NAMES.get(self._rbf, self._rbf)
+        if kernel in NO_TAIL_KERNELS:
+            self._f = RBFInterpolator(self._known_in, self._known_val, neighbors=self._neighbors,
+                                      kernel=kernel, epsilon=1. / self._rbf_const, degree=-1)
+        else:
+            self._f = RBFInterpolator(self._known_in, self._known_val, neighbors=self._neighbors,
+                                      kernel=kernel, epsilon=1. / self._rbf_const)
 
-    def predict(self, x_pred):
-        if self._k == 1:
-            return self._f(x_pred[0])
-        elif self._k == 2:
-            return self._f(x_pred[0], x_pred[1])
-        elif self._k == 3:
-            return self._f(x_pred[0], x_pred[1], x_pred[2])
+    def predict_batch(self, x_pred, chunk_size=PREDICT_CHUNK):
+        """
+        predicts the values of many points at once, the points are processed in chunks to bound the memory usage
+        :param x_pred: matrix of input values (m x k)
+        :param chunk_size: number of points per chunk
+        :return: array of m result values
+        """
+        x_pred = np.asarray(x_pred, dtype=float).reshape((-1, self._k))
+        fx = np.empty(x_pred.shape[0])
+        for i in range(0, x_pred.shape[0], chunk_size):
+            fx[i:i + chunk_size] = self._f(x_pred[i:i + chunk_size])
+        return fx
 
 
 if __name__ == '__main__':
     r = RBFscipy(np.array([[0,2,4,6,8],[1,2,3,4,5]]).T, [1,2,1,0,1])
     r.update_param(1., 'linear')
-    print('done')
\ No newline at end of file
+    print('done')
@@ -13,14 +13,34 @@ __status__ = "Development"
 
 from myutils.plot_helper import PlotHelper
 from myutils.time_track import TimeTrack
+from mylibs.batch_predictor import PREDICT_CHUNK
 from mylibs.likeli_optimizer import LikeliOptimizer
+from mylibs.multi_start_optimizer import MultiStartOptimizer
+from mylibs.opti_budget import OptiBudget
+from mylibs.opti_budget import BudgetExceeded
 
 import numpy as np
-import math
+from collections import OrderedDict
+from scipy.spatial import cKDTree
 from scipy.optimize import minimize
 from scipy.optimize import basinhopping
+from scipy.linalg import lapack
+from scipy.linalg import cho_solve
+from scipy.linalg import solve_triangular
 
 VERBOSE = False
+# relative nugget that gets added to the diagonal if the correlation matrix is numerically singular
+NUGGET = 1e-12
+# max relative drift of the likelihood per sample point before add_points optimizes theta and p again
+DRIFT_TOL = 0.1
+# default neighbourhood size and number of cached neighbourhood factorizations of the local kriging mode
+LOCAL_NEIGHBORS = 30
+LOCAL_CACHE = 1024
+# size of the likelihood memo of the optimizer and the number of digits its (log10(theta), p) keys are rounded to
+LIKELI_MEMO = 256
+LIKELI_DIGITS = 10
+# max number of matrix entries (candidates x n x n x k) calc_likelihood_batch holds in memory at once
+BATCH_ENTRIES = 2 ** 22
 
 
 class Kriging:
@@ -38,10 +58,32 @@ class Kriging:
         self._n = self._known_in.shape[0]
         self._theta = 1. * np.ones((self._k, 1)).flatten()
         self._p = 2. * np.ones((self._k, 1)).flatten()
-        self._cor_mat = None
-        self._core_mat_inv = None
+        # per dimension absolute distances |x_i - x_j| (n x n x k), they only depend on the known inputs
+        self._dist = np.abs(self._known_in[:, np.newaxis, :] - self._known_in[np.newaxis, :, :])
+        # lower cholesky factor of the correlation matrix, replaces the explicit inverse
+        self._cor_chol = None
+        # nugget on the diagonal of the factorized correlation matrix (0 if _factorize did not need one)
+        self._cor_nugget = 0.
+        self._ln_det_cor_mat = None
         self._mu = None
-        self._mat_u = None
+        self._sigma_sqr = None
+        # R^-1 (y - 1 * mu), the weights of the correlation vector in predict
+        self._weights = None
+        # L^-1 1 for the prediction variance
+        self._chol_inv_one = None
+        # True if theta or p changed and the factorization is not updated yet (see _ensure_model)
+        self._dirty = True
+        # [log10(theta), p] of the last evaluation by the optimizer (the gradient reuses its factorization)
+        self._opti_params = None
+        # LRU memo of the likelihoods the optimizer already evaluated
+        self._like_memo = OrderedDict()
+        self.records = None
+        # OptiBudget of the last optimize call (evaluation counts, timing per phase, budget hit)
+        self.opti_report = None
+        # local kriging mode (see set_local)
+        self._local_neighbors = None
+        self._kd_tree = None
+        self._local_cache = OrderedDict()
 
     def train(self):
         """
@@ -59,37 +101,141 @@ class Kriging:
         """
         self._theta = np.array(theta)
         self._p = np.array(p)
-        self._calc_cormat()
+        self._opti_params = None
+        self._reset_local()
+        # the factorization is deferred until a quantity of the model is requested
+        self._dirty = True
+
+    def _ensure_model(self):
+        """
+        factorizes the correlation matrix and calculates mu if theta or p changed since the last time
+        :return: None
+        """
+        if self._dirty:
+            self._calc_cormat()
+            self._calc_mu()
+            self._dirty = False
+
+    def add_points(self, new_in, new_val, drift_tol=DRIFT_TOL, **opti_args):
+        """
+        adds sample points by extending the cholesky factor (block update) while keeping theta and p,
+        theta and p only get optimized again if the likelihood per sample point drifts too much
+        :param new_in: list of lists with the new input sample points
+        :param new_val: list of results for new_in
+        :param drift_tol: max relative change of the neg. log. likelihood per sample point without new optimization
+        :param opti_args: arguments passed to optimize if it is needed
+        :return: True if theta and p got optimized again
+        """
+        new_in = np.array(new_in, dtype=float).reshape((-1, self._k))
+        new_val = np.array(new_val, dtype=float).flatten()
+        m = new_in.shape[0]
+        self._ensure_model()
+        like_old = self.calc_likelihood() / self._n
+        # extend the cached distances by the new rows and columns
+        new_dist = np.abs(new_in[:, np.newaxis, :] - self._known_in[np.newaxis, :, :])
+        dist = np.zeros((self._n + m, self._n + m, self._k))
+        dist[:self._n, :self._n] = self._dist
+        dist[self._n:, :self._n] = new_dist
+        dist[:self._n, self._n:] = np.transpose(new_dist, (1, 0, 2))
+        dist[self._n:, self._n:] = np.abs(new_in[:, np.newaxis, :] - new_in[np.newaxis, :, :])
+        old_chol = self._cor_chol
+        self._dist = dist
+        self._known_in = np.vstack((self._known_in, new_in))
+        self._known_val = np.concatenate((self._known_val, new_val))
+        self._n += m
+        self._opti_params = None
+        self._like_memo.clear()
+        self._reset_local()
+        cor_new = np.exp(-((dist[self._n - m:] ** self._p) @ self._theta))
+        updated = False
+        if old_chol is not None:
+            # [[L11, 0], [L21, L22]] with L21 = (L11^-1 R12)^T and L22 L22^T = R22 - L21 L21^T,
+            # R22 gets the same nugget as the factorized R11
+            chol_21 = solve_triangular(old_chol, cor_new[:, :self._n - m].T, lower=True, check_finite=False).T
+            schur = cor_new[:, self._n - m:] + self._cor_nugget * np.eye(m) - chol_21 @ chol_21.T
+            chol_22, info = lapack.dpotrf(schur, lower=1, clean=1)
+            if info == 0:
+                chol = np.zeros((self._n, self._n))
+                chol[:self._n - m, :self._n - m] = old_chol
+                chol[self._n - m:, :self._n - m] = chol_21
+                chol[self._n - m:, self._n - m:] = chol_22
+                self._cor_chol = chol
+                self._ln_det_cor_mat += 2. * np.sum(np.log(np.diag(chol_22)))
+                updated = True
+        if not updated:
+            # e.g. a new point is (nearly) equal to a known one, refactorize everything (with nugget if needed)
+            self._calc_cormat()
         self._calc_mu()
+        like_new = self.calc_likelihood() / self._n
+        if np.isfinite(like_old) and abs(like_new - like_old) <= drift_tol * max(1., abs(like_old)):
+            return False
+        if VERBOSE:
+            print('likelihood drift too large, optimizing theta and p again')
+        self.optimize(**opti_args)
+        return True
 
     #calcs the correlation matrix
     def _calc_cormat(self):
         """
         :return: correlation matrix
         """
-        cor_mat = np.zeros((self._n, self._n))
-        for i in range(0, self._n):
-            for j in range(i, self._n):
-                sum = 0.
-                for ik in range(0, self._k):
-                    sum += self._theta[ik] * (abs(self._known_in[i][ik] - self._known_in[j][ik]) ** self._p[ik])
-                cor_mat[i][j] = math.exp(-sum)
-                cor_mat[j][i] = cor_mat[i][j]
-        try:
-            self._core_mat_inv = np.linalg.inv(cor_mat)
-            self._cor_mat = cor_mat
-        except Exception as e:
-            if VERBOSE:
-                print('ERROR: could not calc np.linalg.inv: ' + str(e))
+        if np.all(self._p == 2.):
+            # fast path: sum(theta * (x_i - x_j)^2) is a squared distance of the theta scaled inputs (BLAS matmul)
+            scaled_in = self._known_in * np.sqrt(self._theta)
+            sqr_norm = np.sum(scaled_in ** 2, axis=1)
+            dist_sum = sqr_norm[:, np.newaxis] + sqr_norm[np.newaxis, :] - 2. * (scaled_in @ scaled_in.T)
+            np.maximum(dist_sum, 0., out=dist_sum)
+        else:
+            dist_sum = (self._dist ** self._p) @ self._theta
+        cor_mat = np.exp(-dist_sum)
+        # the diagonal is exactly one, the fast path might have rounding errors there
+        np.fill_diagonal(cor_mat, 1.)
+        self._factorize(cor_mat)
         return cor_mat
 
+    def _factorize(self, cor_mat):
+        """
+        cholesky factorization of the correlation matrix (lapack potrf reports errors by its info flag, no exceptions)
+        if the matrix is not positive definite a tiny nugget is added to its diagonal and it is tried again
+        :param cor_mat: correlation matrix (a nugget gets added in place if needed)
+        :return: True if the factorization succeeded
+        """
+        self._cor_nugget = 0.
+        chol, info = lapack.dpotrf(cor_mat, lower=1, clean=1)
+        if info != 0:
+            if VERBOSE:
+                print('WARNING: correlation matrix not positive definite, adding nugget')
+            self._cor_nugget = NUGGET * self._n
+            cor_mat[np.diag_indices_from(cor_mat)] += self._cor_nugget
+            chol, info = lapack.dpotrf(cor_mat, lower=1, clean=1)
+        if info != 0:
+            if VERBOSE:
+                print('ERROR: could not calc cholesky factorization (info: {:d})'.format(info))
+            self._cor_chol = None
+            self._ln_det_cor_mat = None
+            return False
+        self._cor_chol = chol
+        self._ln_det_cor_mat = 2. * np.sum(np.log(np.diag(chol)))
+        return True
+
     def _calc_mu(self):
         """
+        calculates mu, sigma^2 and the prediction weights from the cholesky factor
         :return: the factor mu
         """
+        if self._cor_chol is None:
+            self._mu = None
+            self._sigma_sqr = None
+            self._weights = None
+            self._chol_inv_one = None
+            return self._mu
         one = np.ones((self._n, 1)).flatten()
-        self._mu = (np.transpose(one) @ self._core_mat_inv @ self._known_val) / (
-                np.transpose(one) @ self._core_mat_inv @ one)
+        # R^-1 @ [1, y] in one triangular solve pair
+        inv_one, inv_val = cho_solve((self._cor_chol, True), np.column_stack((one, self._known_val)), check_finite=False).T
+        self._mu = np.sum(inv_val) / np.sum(inv_one)
+        self._weights = inv_val - self._mu * inv_one
+        self._sigma_sqr = ((self._known_val - one * self._mu) @ self._weights) / self._n
+        self._chol_inv_one = solve_triangular(self._cor_chol, one, lower=True, check_finite=False)
         return self._mu
 
     def calc_likelihood(self):
@@ -97,24 +243,114 @@ class Kriging:
         calculates the negative logarithmic likelihood
         :return: negative logarithmic likelihood (or infinity if an error appears)
         """
-        ln_det_cor_mat = np.linalg.slogdet(self._cor_mat)[1]
+        self._ensure_model()
+        if self._cor_chol is None:
+            return float('inf')
+        ln_det_cor_mat = self._ln_det_cor_mat
         if np.isnan(ln_det_cor_mat):
             if VERBOSE:
                 print('NaN Alarm')
             return float('inf')
-        one = np.ones((self._n, 1)).flatten()
-        sigma_sqr = (np.transpose(self._known_val - one * self._mu) @ self._core_mat_inv @ (self._known_val - one * self._mu)) / self._n
-        if sigma_sqr < 0.:
+        sigma_sqr = self._sigma_sqr
+        if not sigma_sqr > 0.:
             if VERBOSE:
                 print('Error: neg sigmaSqr')
             return float('inf')
         neg_ln_like = (-1) * (-(self._n / 2) * np.log(sigma_sqr) - 0.5 * ln_det_cor_mat)
-        if neg_ln_like == float('nan'):
+        if np.isnan(neg_ln_like):
             if VERBOSE:
                 print('Error: nan')
             return float('inf')
         return neg_ln_like
 
+    def calc_likelihood_gradient(self):
+        """
+        analytic gradient of the negative logarithmic likelihood (concentrated in mu and sigma^2)
+        d/d phi = 0.5 * sum((R^-1 - w w^T / sigma^2) * dR/d phi) with w = R^-1 (y - 1 * mu)
+        :return: gradient with respect to [log10(theta), p] (zeros if the likelihood is not defined)
+        """
+        grad = np.zeros((2 * self._k))
+        self._ensure_model()
+        if self._cor_chol is None or not self._sigma_sqr > 0.:
+            return grad
+        cor_inv = cho_solve((self._cor_chol, True), np.eye(self._n), check_finite=False)
+        dist_p = self._dist ** self._p
+        cor_mat = np.exp(-(dist_p @ self._theta))
+        like_mat = (cor_inv - np.outer(self._weights, self._weights) / self._sigma_sqr) * cor_mat
+        # dR/d theta_k = -R * |x_i - x_j|^p_k, chain rule for theta = 10^e gives the factor theta_k * ln(10)
+        grad[:self._k] = -0.5 * np.log(10.) * self._theta * np.einsum('ij,ijk->k', like_mat, dist_p)
+        # dR/d p_k = -R * theta_k * |x_i - x_j|^p_k * ln|x_i - x_j| (zero for equal coordinates)
+        ln_dist = np.log(np.where(self._dist > 0., self._dist, 1.))
+        grad[self._k:] = -0.5 * self._theta * np.einsum('ij,ijk->k', like_mat, dist_p * ln_dist)
+        return grad
+
+    def calc_likelihood_batch(self, thetas, ps):
+        """
+        calculates the negative logarithmic likelihood for a stack of parameter candidates at once,
+        the model itself stays untouched
+        :param thetas: matrix of theta vectors (c x k)
+        :param ps: matrix of p vectors (c x k)
+        :return: array of c negative logarithmic likelihoods (infinity where an error appears)
+        """
+        thetas = np.asarray(thetas, dtype=float).reshape((-1, self._k))
+        ps = np.asarray(ps, dtype=float).reshape((-1, self._k))
+        neg_ln_like = np.empty(thetas.shape[0])
+        chunk_size = max(1, BATCH_ENTRIES // (self._n * self._n * self._k))
+        for i in range(0, thetas.shape[0], chunk_size):
+            neg_ln_like[i:i + chunk_size] = self._calc_likelihood_stack(thetas[i:i + chunk_size], ps[i:i + chunk_size])
+        return neg_ln_like
+
+    def _calc_likelihood_stack(self, thetas, ps):
+        """
+        likelihoods of one chunk of candidates using stacked correlation matrices and a batched cholesky
+        :param thetas: matrix of theta vectors (c x k)
+        :param ps: matrix of p vectors (c x k)
+        :return: array of c negative logarithmic likelihoods
+        """
+        dist_sum = np.einsum('cijk,ck->cij', self._dist[np.newaxis] ** ps[:, np.newaxis, np.newaxis, :], thetas)
+        cor_mats = np.exp(-dist_sum)
+        valid = np.ones(cor_mats.shape[0], dtype=bool)
+        try:
+            chols = np.linalg.cholesky(cor_mats)
+        except np.linalg.LinAlgError:
+            # at least one matrix is not positive definite, factorize them one by one like _factorize does
+            chols = np.zeros(cor_mats.shape)
+            for c in range(0, cor_mats.shape[0]):
+                chol, info = lapack.dpotrf(cor_mats[c], lower=1, clean=1)
+                if info != 0:
+                    cor_mats[c][np.diag_indices(self._n)] += NUGGET * self._n
+                    chol, info = lapack.dpotrf(cor_mats[c], lower=1, clean=1)
+                if info != 0:
+                    valid[c] = False
+                    chol = np.eye(self._n)
+                chols[c] = chol
+        diags = np.diagonal(chols, axis1=1, axis2=2)
+        ln_det_cor_mat = 2. * np.sum(np.log(diags), axis=1)
+        # forward substitution L^-1 [1, y] for all candidates at once
+        rhs = np.column_stack((np.ones(self._n), self._known_val))
+        z = np.zeros((cor_mats.shape[0], self._n, 2))
+        for i in range(0, self._n):
+            z[:, i, :] = (rhs[i] - np.einsum('cj,cjr->cr', chols[:, i, :i], z[:, :i, :])) / diags[:, i, np.newaxis]
+        z_one = z[:, :, 0]
+        z_val = z[:, :, 1]
+        mu = np.sum(z_one * z_val, axis=1) / np.sum(z_one * z_one, axis=1)
+        sigma_sqr = np.sum((z_val - mu[:, np.newaxis] * z_one) ** 2, axis=1) / self._n
+        with np.errstate(divide='ignore', invalid='ignore'):
+            neg_ln_like = (self._n / 2) * np.log(sigma_sqr) + 0.5 * ln_det_cor_mat
+        neg_ln_like[~valid | ~(sigma_sqr > 0.) | np.isnan(neg_ln_like)] = float('inf')
+        return neg_ln_like
+
+    def _calc_likelihood_opti_exp_batch(self, params, *args):
+        """
+        batched version of _calc_likelihood_opti_exp
+        :param params: matrix with one [log10(theta), p] candidate per row
+        :return: array of negative logarithmic likelihoods
+        """
+        params = np.asarray(params, dtype=float).reshape((-1, 2 * self._k))
+        if self.records != None:
+            self.records.extend(list(params))
+        return self.calc_likelihood_batch(10. ** params[:, 0:self._k], params[:, self._k:])
+
     def _calc_likelihood_opti_theta_only(self, params, *args):
         self.update_param(params, args[0])
         neg_ln_like = self.calc_likelihood()
@@ -134,12 +370,33 @@ class Kriging:
         thetas = []
         for e in exps:
             thetas.append(10.**e)
+        # only sets the parameters, the factorization is skipped for parameters the memo knows
         self.update_param(thetas, params[self._k:])
-        neg_ln_like = self.calc_likelihood()
+        self._opti_params = np.array(params, dtype=float)
+        key = np.round(self._opti_params, LIKELI_DIGITS).tobytes()
+        if key in self._like_memo:
+            self._like_memo.move_to_end(key)
+            neg_ln_like = self._like_memo[key]
+        else:
+            neg_ln_like = self.calc_likelihood()
+            self._like_memo[key] = neg_ln_like
+            if len(self._like_memo) > LIKELI_MEMO:
+                self._like_memo.popitem(last=False)
         if self.records != None:
             self.records.append(params)
         return neg_ln_like
 
+    def _calc_likelihood_opti_exp_grad(self, params, *args):
+        """
+        gradient for _calc_likelihood_opti_exp, reuses the factorization if the optimizer just evaluated params
+        :param params: [log10(theta), p]
+        :return: gradient of the neg. log. likelihood
+        """
+        if self._opti_params is None or not np.array_equal(self._opti_params, params):
+            self.update_param(10. ** np.array(params[0:self._k]), params[self._k:])
+            self._opti_params = np.array(params, dtype=float)
+        return self.calc_likelihood_gradient()
+
     def optimize_theta_only(self):
         x0 = np.ones((self._k,1)).flatten()
         bnds = []
@@ -151,19 +408,50 @@ class Kriging:
         res = minimize(self._calc_likelihood_opti_theta_only, x0, args=self._p, method='SLSQP', tol=1e-6, options=opt, bounds=bnds)
         self._theta = res.x
 
-    def optimize(self, init_guess=None, opti_algo='grid', record_data=False):
+    def optimize(self, init_guess=None, opti_algo='grid', record_data=False, seed=0, workers=None, max_time=None, max_evals=None,
+                 cache=None, cache_scaling=None):
         """
         runs automatic optimization of thetas and ps
         :param init_guess: list of input values for an initial guess
-        :param opti_algo: string for the algorithm to use 'grid' (self implemented LikeliOptimizer) or 'basin' (using scipy.optimize.basin-hopping)
-        :param record_data: if True the test points of the optimizer gets recorded (this is needed for plot of optimizer path in plot_likelihoods)
+        :param opti_algo: string for the algorithm to use 'grid' (self implemented LikeliOptimizer), 'adaptive' (LikeliOptimizer with coarse to fine search), 'basin' (using scipy.optimize.basin-hopping) or 'multi' (parallel multi-start MultiStartOptimizer)
+        :param record_data: if True the test points of the optimizer gets recorded (this is needed for plot of optimizer path in plot_likelihoods), evaluations in worker processes are not recorded
+        :param seed: seed for the random numbers of 'basin' and 'multi'
+        :param workers: number of worker processes for 'multi', 'grid' and 'adaptive' (None runs it in this process)
+        :param max_time: wall clock budget in seconds, afterwards the best parameters so far are used (None for no limit)
+        :param max_evals: maximum number of likelihood evaluations (None for no limit)
+        :param cache: optional HyperCache, a cached data set is not optimized at all and a similar one replaces the
+        search of opti_algo by a local search from its optimum, the result gets stored in the cache
+        :param cache_scaling: list of scaling values of the samples, part of the cache key
         :return: None
         """
         timer = TimeTrack('optiTimer')
+        budget = OptiBudget(max_time=max_time, max_evals=max_evals)
+        self.opti_report = budget
         self.records = None
         if record_data:
             self.records = []
-        if 'basin' in opti_algo:
+        warm_start = None
+        if cache is not None:
+            warm_start, cache_hit = cache.lookup(self._known_in, self._known_val, scaling=cache_scaling)
+            if cache_hit:
+                if VERBOSE:
+                    print('Kriging parameters found in cache')
+                self.update_param(10. ** warm_start[0:self._k], warm_start[self._k:])
+                return
+        if warm_start is not None:
+            # nearly identical data sets have nearly identical optima, a local search is enough
+            bnds = [(-5., +5.)] * self._k + [(1., 2.)] * self._k
+            timer.tic()
+            budget.start_phase('warm start')
+            try:
+                res = minimize(budget.wrap(self._calc_likelihood_opti_exp), warm_start, method='SLSQP',
+                               jac=self._calc_likelihood_opti_exp_grad, tol=1e-8,
+                               options={'disp': False, 'maxiter': 5e3}, bounds=bnds)
+            except BudgetExceeded:
+                res = budget.result()
+            budget.end_phase()
+            timer.toc(print_it=True)
+        elif 'basin' in opti_algo:
             # basinhopping:
             if init_guess is None:
                 init_guess = []
@@ -177,24 +465,51 @@ class Kriging:
             for i in range(0, self._k):
                 bnds.append((1., 2.))
             bounds = BasinHoppingBounds(xmax=list(zip(*bnds))[1], xmin=list(zip(*bnds))[0])
-            step = BasinHoppingStep()
-            minimizer_kwargs = dict(method='SLSQP', bounds=bnds, options={'disp': False, 'maxiter': 5e3}, tol=1e-4)
+            step = BasinHoppingStep(seed=seed)
+            minimizer_kwargs = dict(method='SLSQP', bounds=bnds, jac=self._calc_likelihood_opti_exp_grad,
+                                    options={'disp': False, 'maxiter': 5e3}, tol=1e-4)
+            timer.tic()
+            budget.start_phase('basin')
+            try:
+                res = basinhopping(budget.wrap(self._calc_likelihood_opti_exp),
+                                   init_guess,
+                                   minimizer_kwargs=minimizer_kwargs,
+                                   accept_test=bounds,
+                                   take_step=step,
+                                   niter=1000,
+                                   niter_success=100,
+                                   seed=seed)
+            except BudgetExceeded:
+                res = budget.result()
+            budget.end_phase()
+            timer.toc(print_it=True)
+        elif 'multi' in opti_algo:
+            multi = MultiStartOptimizer(workers=workers, seed=seed)
+            timer.tic()
+            res = multi.find(self._calc_likelihood_opti_exp, self._k, jac=self._calc_likelihood_opti_exp_grad, budget=budget)
+            timer.toc(print_it=True)
+        elif 'adaptive' in opti_algo:
+            skipper = LikeliOptimizer(debug=True)
             timer.tic()
-            res = basinhopping(self._calc_likelihood_opti_exp,
-                               init_guess,
-                               minimizer_kwargs=minimizer_kwargs,
-                               accept_test=bounds,
-                               take_step=step,
-                               niter=1000,
-                               niter_success=100)
+            res = skipper.find(self._calc_likelihood_opti_exp, self._k, jac=self._calc_likelihood_opti_exp_grad,
+                               batch_func=self._calc_likelihood_opti_exp_batch, workers=workers, adaptive=True, budget=budget)
             timer.toc(print_it=True)
         elif 'grid' in opti_algo:
             skipper = LikeliOptimizer(debug=True)
             timer.tic()
-            res = skipper.find(self._calc_likelihood_opti_exp, self._k)
+            res = skipper.find(self._calc_likelihood_opti_exp, self._k, jac=self._calc_likelihood_opti_exp_grad,
+                               batch_func=self._calc_likelihood_opti_exp_batch, workers=workers, budget=budget)
             timer.toc(print_it=True)
         else:
             raise Exception('ERROR: unknown optimizer selected')
+        if budget.budget_hit:
+            print('WARNING: Kriging optimization budget used up, using the best parameters found so far')
+        if record_data or budget.budget_hit:
+            print(budget.summary())
+        if res.x is None:
+            # the budget was used up before anything got evaluated, keep the current parameters
+            self.update_param(self._theta, self._p)
+            return
         exps = res.x[0:self._k]
         thetas = []
         for e in exps:
@@ -202,23 +517,190 @@ class Kriging:
         if record_data:
             print('Kriging Likelihood optimization evaluations: {:d}'.format(len(self.records)))
         self.update_param(thetas, res.x[self._k:])
+        # parameters of a search cut off by the budget (or a failed fit) must not become warm starts or cache hits
+        if cache is not None and not budget.budget_hit:
+            neg_ln_like = self.calc_likelihood()
+            if np.isfinite(neg_ln_like):
+                cache.store(self._known_in, self._known_val, res.x, neg_ln_like, scaling=cache_scaling)
+
+    def _calc_psi(self, x_pred, known_in=None):
+        """
+        correlation between the points x_pred and all known points
+        :param x_pred: matrix of input values (m x k)
+        :param known_in: optional subset of the known points (default all of them)
+        :return: correlation matrix (m x n)
+        """
+        if known_in is None:
+            known_in = self._known_in
+        if np.all(self._p == 2.):
+            sqrt_theta = np.sqrt(self._theta)
+            scaled_in = known_in * sqrt_theta
+            scaled_pred = x_pred * sqrt_theta
+            dist_sum = np.sum(scaled_pred ** 2, axis=1)[:, np.newaxis] \
+                + np.sum(scaled_in ** 2, axis=1)[np.newaxis, :] - 2. * (scaled_pred @ scaled_in.T)
+            np.maximum(dist_sum, 0., out=dist_sum)
+        else:
+            dist = np.abs(x_pred[:, np.newaxis, :] - known_in[np.newaxis, :, :])
+            dist_sum = (dist ** self._p) @ self._theta
+        return np.exp(-dist_sum)
 
-    def predict(self, x_pred):
+    def set_local(self, neighbors=LOCAL_NEIGHBORS):
+        """
+        switches predict to local kriging: every point is predicted from its nearest known points only,
+        they are found by a kd-tree and the factorization of every neighbourhood is cached
+        :param neighbors: number of known points per neighbourhood (None switches back to global kriging)
+        :return: None
+        """
+        self._local_neighbors = None if neighbors is None else min(int(neighbors), self._n)
+        self._reset_local()
+
+    def _reset_local(self):
+        self._kd_tree = None
+        self._local_cache.clear()
+
+    def _local_model(self, indices):
+        """
+        ordinary kriging system of one neighbourhood, cached by its point indices
+        :param indices: sorted indices of the neighbourhood points
+        :return: (cholesky factor, mu, weights, L^-1 1, sigma^2) or None if the factorization failed
+        """
+        key = indices.tobytes()
+        if key in self._local_cache:
+            self._local_cache.move_to_end(key)
+            return self._local_cache[key]
+        cor_mat = self._calc_psi(self._known_in[indices], known_in=self._known_in[indices])
+        np.fill_diagonal(cor_mat, 1.)
+        chol, info = lapack.dpotrf(cor_mat, lower=1, clean=1)
+        if info != 0:
+            cor_mat[np.diag_indices_from(cor_mat)] += NUGGET * len(indices)
+            chol, info = lapack.dpotrf(cor_mat, lower=1, clean=1)
+        model = None
+        if info == 0:
+            one = np.ones(len(indices))
+            known_val = self._known_val[indices]
+            inv_one, inv_val = cho_solve((chol, True), np.column_stack((one, known_val)), check_finite=False).T
+            mu = np.sum(inv_val) / np.sum(inv_one)
+            weights = inv_val - mu * inv_one
+            sigma_sqr = ((known_val - mu) @ weights) / len(indices)
+            model = (chol, mu, weights, solve_triangular(chol, one, lower=True, check_finite=False), sigma_sqr)
+        self._local_cache[key] = model
+        if len(self._local_cache) > LOCAL_CACHE:
+            self._local_cache.popitem(last=False)
+        return model
+
+    def _predict_local(self, x_pred, return_var=False):
+        """
+        local kriging prediction, points that share a neighbourhood are predicted together
+        :param x_pred: matrix of input values (m x k)
+        :param return_var: if True the local kriging variance gets returned too
+        :return: array of m result values, with return_var a tuple (values, variances)
+        """
+        if self._kd_tree is None:
+            # the tree works on inputs scaled by theta^(1/p), so near means highly correlated
+            self._kd_tree = cKDTree(self._known_in * self._theta ** (1. / self._p))
+        _, neighbors = self._kd_tree.query(x_pred * self._theta ** (1. / self._p), k=self._local_neighbors)
+        neighbors = np.sort(neighbors.reshape((x_pred.shape[0], -1)), axis=1)
+        groups, group_i = np.unique(neighbors, axis=0, return_inverse=True)
+        group_i = group_i.flatten()
+        fx = np.full(x_pred.shape[0], np.nan)
+        var = np.full(x_pred.shape[0], np.nan)
+        for g in range(0, len(groups)):
+            model = self._local_model(groups[g])
+            if model is None:
+                continue
+            chol, mu, weights, chol_inv_one, sigma_sqr = model
+            in_group = group_i == g
+            psi = self._calc_psi(x_pred[in_group], known_in=self._known_in[groups[g]])
+            fx[in_group] = mu + psi @ weights
+            if return_var:
+                chol_inv_psi = solve_triangular(chol, psi.T, lower=True, check_finite=False)
+                one_inv_psi = chol_inv_one @ chol_inv_psi
+                var[in_group] = np.maximum(sigma_sqr * (1. - np.sum(chol_inv_psi ** 2, axis=0)
+                                                        + (1. - one_inv_psi) ** 2 / (chol_inv_one @ chol_inv_one)), 0.)
+        if return_var:
+            return fx, var
+        return fx
+
+    def predict(self, x_pred, return_var=False):
         """
         predicts a value from the surrogate model
-        :param x_pred: vector of input values
-        :return: result value
+        :param x_pred: vector of input values (or a matrix with one point per row, see predict_batch)
+        :param return_var: if True the kriging variance (mean squared error) gets returned too
+        :return: result value (or array of result values), with return_var a tuple (value, variance)
         """
-        one = np.ones((self._n, 1)).flatten()
-        psi = np.ones((self._n, 1)).flatten()
-        for i in range(0, self._n):
-            sum = 0.
-            for ik in range(0, self._k):
-                sum += self._theta[ik] * (abs(self._known_in[i][ik] - x_pred[ik]) ** self._p[ik])
-            psi[i] = math.exp(-sum)
-        fx = self._mu + np.transpose(psi) @ self._core_mat_inv @ (self._known_val - one * self._mu)
+        x_pred = np.asarray(x_pred, dtype=float)
+        if x_pred.ndim > 1:
+            return self.predict_batch(x_pred, return_var=return_var)
+        res = self.predict_batch(x_pred.reshape((1, self._k)), return_var=return_var)
+        if return_var:
+            return res[0][0], res[1][0]
+        return res[0]
+
+    def predict_batch(self, x_pred, chunk_size=PREDICT_CHUNK, return_var=False):
+        """
+        predicts the values of many points at once, the points are processed in chunks to bound the memory usage
+        (in local mode every point only uses its neighbourhood, see set_local)
+        :param x_pred: matrix of input values (m x k)
+        :param chunk_size: number of points per chunk
+        :param return_var: if True the kriging variance (mean squared error) gets returned too
+        :return: array of m result values, with return_var a tuple (values, variances)
+        """
+        x_pred = np.asarray(x_pred, dtype=float).reshape((-1, self._k))
+        if self._local_neighbors is not None:
+            return self._predict_local(x_pred, return_var=return_var)
+        self._ensure_model()
+        fx = np.empty(x_pred.shape[0])
+        var = np.empty(x_pred.shape[0]) if return_var else None
+        one_inv_one = self._chol_inv_one @ self._chol_inv_one
+        for i in range(0, x_pred.shape[0], chunk_size):
+            psi = self._calc_psi(x_pred[i:i + chunk_size])
+            fx[i:i + chunk_size] = self._mu + psi @ self._weights
+            if return_var:
+                # s^2 = sigma^2 * (1 - psi^T R^-1 psi + (1 - 1^T R^-1 psi)^2 / (1^T R^-1 1))
+                chol_inv_psi = solve_triangular(self._cor_chol, psi.T, lower=True, check_finite=False)
+                one_inv_psi = self._chol_inv_one @ chol_inv_psi
+                var_chunk = self._sigma_sqr * (1. - np.sum(chol_inv_psi ** 2, axis=0)
+                                               + (1. - one_inv_psi) ** 2 / one_inv_one)
+                var[i:i + chunk_size] = np.maximum(var_chunk, 0.)
+        if return_var:
+            return fx, var
         return fx
 
+    def predict_gradient(self, x_pred):
+        """
+        gradient of the predicted value with respect to the inputs
+        :param x_pred: vector of input values (or a matrix with one point per row, see predict_gradient_batch)
+        :return: gradient vector (or matrix with one gradient per row)
+        """
+        x_pred = np.asarray(x_pred, dtype=float)
+        if x_pred.ndim > 1:
+            return self.predict_gradient_batch(x_pred)
+        return self.predict_gradient_batch(x_pred.reshape((1, self._k)))[0]
+
+    def predict_gradient_batch(self, x_pred, chunk_size=PREDICT_CHUNK):
+        """
+        analytic gradients of the predictor mu + psi^T R^-1 (y - 1 * mu), only psi depends on x, so the cached weights
+        are reused: d psi_j / d x_d = -psi_j * theta_d * p_d * |x_d - x_jd|^(p_d - 1) * sign(x_d - x_jd)
+        :param x_pred: matrix of input values (m x k)
+        :param chunk_size: number of points per chunk
+        :return: matrix of gradients (m x k)
+        """
+        if self._local_neighbors is not None:
+            raise Exception('ERROR: predict_gradient is not available in local mode (see set_local)')
+        x_pred = np.asarray(x_pred, dtype=float).reshape((-1, self._k))
+        self._ensure_model()
+        grad = np.empty(x_pred.shape)
+        for i in range(0, x_pred.shape[0], chunk_size):
+            chunk = x_pred[i:i + chunk_size]
+            diff = chunk[:, np.newaxis, :] - self._known_in[np.newaxis, :, :]
+            weighted_psi = self._calc_psi(chunk) * self._weights
+            if np.all(self._p == 2.):
+                d_dist = 2. * diff
+            else:
+                d_dist = self._p * np.abs(diff) ** (self._p - 1.) * np.sign(diff)
+            grad[i:i + chunk_size] = -np.einsum('mn,mnk->mk', weighted_psi, d_dist) * self._theta
+        return grad
+
     def plot_theta_likelihood_r2(self, ax=None, pgf=False, opti_path=[]):
         """
         plot colormap of likelihood for theta1 and theta2
@@ -351,15 +833,17 @@ class BasinHoppingBounds(object):
 
 class BasinHoppingStep(object):
 
-    def __init__(self, stepsize=1.):
+    def __init__(self, stepsize=1., seed=None):
         self.stepsize = stepsize
+        # own random stream, so runs are reproducible and independent of np.random
+        self.rng = np.random.default_rng(seed)
 
     def __call__(self, x):
         for i in range(0, len(x)):
             if i < len(x) / 2:
-                # theta
-                x[i] = 10**np.random.uniform(-5, 5)
+                # theta (the optimizer works on the exponent)
+                x[i] = self.rng.uniform(-5, 5)
             else:
                 # p
-                x[i] = np.random.uniform(1., 2)
+                x[i] = self.rng.uniform(1., 2)
         return x
\ No newline at end of file
@@ -0,0 +1,143 @@
+__author__ = "Juri Bieler"
+__version__ = "0.0.1"
+__email__ = "juribieler@gmail.com"
+__status__ = "Development"
+
+# ==============================================================================
+# description     :shared hyperparameter handling of the Kriging variants for large sample counts
+# date            :2018-07-23
+# version         :0.01
+# notes           :
+# python_version  :3.6
+# ==============================================================================
+
+from myutils.time_track import TimeTrack
+from mylibs.batch_predictor import BatchPredictor
+from mylibs.likeli_optimizer import LikeliOptimizer
+from mylibs.multi_start_optimizer import MultiStartOptimizer
+from mylibs.opti_budget import OptiBudget
+
+import numpy as np
+
+
+class KrigingBase(BatchPredictor):
+    """
+    base of SparseKriging, GridKriging and CGKriging, a subclass calculates mu, sigma^2, the log determinant and
+    the prediction weights of its model in _calc_model and implements predict_batch
+    """
+    # optimizer used by optimize if no opti_algo is given
+    default_opti_algo = 'adaptive'
+
+    def __init__(self, known_in, known_val):
+        """
+        :param known_in: list of lists with input sample points
+        :param known_val: list of results for the known_in
+        """
+        self._known_in = np.array(known_in, dtype=float)
+        self._known_val = np.array(known_val, dtype=float).flatten()
+        if len(self._known_in.shape) == 1:
+            self._known_in = self._known_in.reshape((self._known_in.shape[0], 1))
+        self._k = self._known_in.shape[1]
+        self._n = self._known_in.shape[0]
+        self._theta = 1. * np.ones((self._k, 1)).flatten()
+        self._p = 2. * np.ones((self._k, 1)).flatten()
+        self._mu = None
+        self._sigma_sqr = None
+        self._ln_det_cor_mat = None
+        self.records = None
+        self.opti_report = None
+
+    def train(self):
+        """
+        trains the surrogate if available
+        :return: None
+        """
+        self.optimize()
+
+    def update_param(self, theta, p):
+        """
+        updates the parameters of the surrogate model
+        :param theta: vector of theta parameters for each entry one (from range [1e-5 .. 1e+5])
+        :param p: vector of p parameters for each entry one (from range[1 ..2])
+        :return: None
+        """
+        self._theta = np.array(theta, dtype=float)
+        self._p = np.array(p, dtype=float)
+        self._calc_model()
+
+    def _calc_model(self):
+        raise NotImplementedError()
+
+    def _check_model(self):
+        """
+        raises an exception if there is no fitted model to predict with
+        :return: None
+        """
+        if self._mu is None or self._weights is None:
+            raise Exception('ERROR: {:s} is not fitted (call update_param or optimize first, the last fit might have '
+                            'failed)'.format(type(self).__name__))
+
+    def calc_likelihood(self):
+        """
+        calculates the negative logarithmic likelihood
+        :return: negative logarithmic likelihood (or infinity if an error appears)
+        """
+        if self._mu is None or not self._sigma_sqr > 0.:
+            return float('inf')
+        neg_ln_like = (self._n / 2) * np.log(self._sigma_sqr) + 0.5 * self._ln_det_cor_mat
+        if np.isnan(neg_ln_like):
+            return float('inf')
+        return neg_ln_like
+
+    def _calc_likelihood_opti_exp(self, params, *args):
+        if np.isnan(params).any():
+            return float('nan')
+        self.update_param(10. ** np.array(params[0:self._k]), params[self._k:])
+        neg_ln_like = self.calc_likelihood()
+        if self.records != None:
+            self.records.append(params)
+        return neg_ln_like
+
+    def optimize(self, opti_algo=None, record_data=False, seed=0, workers=None, max_time=None, max_evals=None):
+        """
+        runs automatic optimization of thetas and ps
+        :param opti_algo: 'adaptive' (LikeliOptimizer with coarse to fine search), 'grid' (full LikeliOptimizer grid) or 'multi' (MultiStartOptimizer), None uses default_opti_algo
+        :param record_data: if True the test points of the optimizer gets recorded, evaluations in worker processes are not recorded
+        :param seed: seed for the random numbers of 'multi'
+        :param workers: number of worker processes (None runs everything in this process)
+        :param max_time: wall clock budget in seconds (None for no limit)
+        :param max_evals: maximum number of likelihood evaluations (None for no limit)
+        :return: None
+        """
+        timer = TimeTrack('optiTimer')
+        budget = OptiBudget(max_time=max_time, max_evals=max_evals)
+        self.opti_report = budget
+        self.records = [] if record_data else None
+        timer.tic()
+        res = self._find_params(self.default_opti_algo if opti_algo is None else opti_algo, seed, workers, budget)
+        timer.toc(print_it=True)
+        if record_data or budget.budget_hit:
+            print(budget.summary())
+        if res.x is None:
+            self.update_param(self._theta, self._p)
+            return
+        self.update_param(10. ** np.array(res.x[0:self._k]), res.x[self._k:])
+
+    def _find_params(self, opti_algo, seed, workers, budget):
+        """
+        :return: the scipy.optimize.minimize like result of the selected optimizer
+        """
+        if 'multi' in opti_algo:
+            return MultiStartOptimizer(workers=workers, seed=seed).find(self._calc_likelihood_opti_exp, self._k, budget=budget)
+        elif 'adaptive' in opti_algo:
+            return LikeliOptimizer(debug=True).find(self._calc_likelihood_opti_exp, self._k, workers=workers,
+                                                    adaptive=True, budget=budget)
+        elif 'grid' in opti_algo:
+            return LikeliOptimizer(debug=True).find(self._calc_likelihood_opti_exp, self._k, workers=workers, budget=budget)
+        raise Exception('ERROR: unknown optimizer selected')
+
+    def get_p(self):
+        return self._p
+
+    def get_theta(self):
+        return self._theta
@@ -12,8 +12,13 @@ __status__ = "Development"
 # ==============================================================================
 
 
+from concurrent.futures import ProcessPoolExecutor
 from scipy.optimize import minimize
 import numpy as np
+import itertools
+
+from mylibs.opti_budget import OptiBudget
+from mylibs.opti_budget import BudgetExceeded
 
 
 class LikeliOptimizer:
@@ -23,16 +28,56 @@ class LikeliOptimizer:
         self.pBounds = (1., 2.)
         self.thetaBoundsExp = (-5, 3)
         self.maxIter = 5e3
+        # number of grid points per call of the batched likelihood function
+        self.batchSize = 4096
+        # settings of the adaptive coarse to fine search
+        self.coarseThetaSections = 4
+        self.coarsePSections = 3
+        self.maxCoarsePoints = 2000
+        self.keepCells = 4
+        self.maxRounds = 30
+        self.adaptiveTol = 1e-6
+        # number of rounds in a row without improvement before the adaptive search stops
+        self.adaptivePatience = 3
 
-    def find(self, func, dimensions):
+    def find(self, func, dimensions, jac=None, batch_func=None, workers=None, adaptive=False, budget=None):
         """
         finds the min neg. log. likelihood by generating a grind and starting gradient based optimization from its best result
         :param func: pointer to the likelihood calculaiton function
         :param dimensions: number of dimensions
+        :param jac: optional pointer to the gradient of func (if None finite differences are used)
+        :param batch_func: optional pointer to a likelihood function that takes a matrix of parameters (one per row)
+        :param workers: number of worker processes for the grid and the adaptive search (None or 1 runs it in this
+        process), without batch_func func has to be picklable then
+        :param adaptive: if True the adaptive coarse to fine search replaces the full grid
+        :param budget: optional OptiBudget, if it is used up the best point so far gets returned
         :return: the minimum as a scipy.optimize.minimize result
         """
+        if budget is None:
+            budget = OptiBudget()
+        try:
+            return self._find(func, dimensions, jac, batch_func, workers, adaptive, budget)
+        except BudgetExceeded:
+            if self.debug:
+                print('WARNING: optimization budget used up (LikeliOptimizer.py)')
+            return budget.result()
+        finally:
+            budget.end_phase()
+
+    def _find(self, func, dimensions, jac, batch_func, workers, adaptive, budget):
         opt={'disp': False, 'maxiter': self.maxIter}
-        guess = self.generate_grid(func, dimensions, 8, 5)
+        if adaptive:
+            budget.start_phase('adaptive')
+            guess = self.adaptive_search(func, dimensions, batch_func=batch_func, workers=workers, budget=budget)
+        elif batch_func is not None or (workers is not None and workers > 1):
+            budget.start_phase('grid')
+            if batch_func is None:
+                batch_func = PointBatch(func)
+            guess = self.generate_grid_batch(batch_func, dimensions, 8, 5, workers=workers, budget=budget)
+        else:
+            budget.start_phase('grid')
+            guess = self.generate_grid(budget.wrap(func), dimensions, 8, 5)
+        budget.start_phase('polish')
 
         bnds = []
         for i in range(0, dimensions):
@@ -42,7 +87,7 @@ class LikeliOptimizer:
             bnds.append((1., 2.))
             #bnds.append((max(1., guess[dimensions+i] * 0.5), min(2., guess[dimensions+i] * 1.5)))
 
-        minima_res = minimize(func, guess, method='SLSQP', tol=1e-8, options=opt, bounds=bnds)
+        minima_res = minimize(budget.wrap(func), guess, method='SLSQP', jac=jac, tol=1e-8, options=opt, bounds=bnds)
         if minima_res.nit >= self.maxIter:
             print('WARNING: max iter was used (LikeliOptimizer.py)')
         return minima_res
@@ -86,6 +131,222 @@ class LikeliOptimizer:
             p_param_i = self.increase_i(p_param_i, len(ps))
         return minima_param
 
+    def generate_grid_batch(self, batch_func, dimensions, theta_sections, p_sections, workers=None, budget=None):
+        """
+        same grid as generate_grid, but evaluated in chunks by a batched likelihood function
+        :param batch_func: pointer to a likelihood function that takes a matrix of parameters (one per row)
+        :param dimensions: number of dimensions
+        :param theta_sections: number of grid values for each theta exponent
+        :param p_sections: number of grid values for each p
+        :param workers: number of worker processes the chunks get spread to (None or 1 runs them in this process)
+        :param budget: optional OptiBudget, the grid is cut short if it is used up
+        :return: the parameters of the best grid point
+        """
+        if budget is None:
+            budget = OptiBudget()
+        params = self.grid_params(dimensions, theta_sections, p_sections)
+        chunk_size = self.batchSize
+        if workers is not None and workers > 1:
+            # at least one chunk per worker
+            chunk_size = max(1, min(chunk_size, -(-len(params) // workers)))
+        chunks = [params[i:i + chunk_size] for i in range(0, len(params), chunk_size)]
+        pool = None
+        wave_size = 1
+        if workers is not None and workers > 1 and len(chunks) > 1:
+            pool = ProcessPoolExecutor(max_workers=workers)
+            wave_size = workers
+        res_vals = []
+        try:
+            # the budget is checked after every wave of chunks
+            for i in range(0, len(chunks), wave_size):
+                wave = self._cut_to_budget(chunks[i:i + wave_size], budget)
+                if len(wave) == 0:
+                    break
+                if pool is None:
+                    wave_vals = [batch_func(chunk) for chunk in wave]
+                else:
+                    wave_vals = list(pool.map(batch_func, wave))
+                for chunk, vals in zip(wave, wave_vals):
+                    budget.record(chunk, vals)
+                res_vals += wave_vals
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        if len(res_vals) == 0:
+            raise BudgetExceeded()
+        res_vals = self._clean_vals(np.concatenate(res_vals))
+        return list(params[int(np.argmin(res_vals))])
+
+    @staticmethod
+    def _cut_to_budget(chunks, budget):
+        """
+        :return: the chunks shortened to the remaining evaluations of the budget (empty if it is used up)
+        """
+        if budget.exhausted():
+            return []
+        remaining = budget.remaining_evals()
+        if remaining is None:
+            return chunks
+        cut = []
+        for chunk in chunks:
+            if remaining <= 0:
+                break
+            cut.append(chunk[:remaining])
+            remaining -= len(cut[-1])
+        return cut
+
+    def _eval_batch(self, func, batch_func, params, budget, pool=None, workers=1):
+        """
+        evaluates params in one batch as far as the budget allows, the rest gets infinity,
+        without batch_func the points are evaluated one by one and the time budget is checked before every point
+        :param pool: optional process pool, the batch gets split into one chunk per worker
+        :return: array of results
+        """
+        cut = self._cut_to_budget([params], budget)
+        if len(cut) == 0:
+            raise BudgetExceeded()
+        if pool is not None:
+            chunks = [chunk for chunk in np.array_split(cut[0], workers) if len(chunk) > 0]
+            chunk_func = batch_func if batch_func is not None else PointBatch(func)
+            vals = self._clean_vals(np.concatenate(list(pool.map(chunk_func, chunks))))
+            budget.record(cut[0], vals)
+        elif batch_func is not None:
+            vals = self._clean_vals(batch_func(cut[0]))
+            budget.record(cut[0], vals)
+        else:
+            point_func = budget.wrap(func)
+            vals = []
+            try:
+                for param in cut[0]:
+                    vals.append(point_func(list(param)))
+            except BudgetExceeded:
+                if len(vals) == 0:
+                    raise
+            vals = self._clean_vals(vals)
+        return np.concatenate((vals, np.full(len(params) - len(vals), float('inf'))))
+
+    def adaptive_search(self, func, dimensions, batch_func=None, workers=None, budget=None):
+        """
+        coarse to fine search: starts with a coarse grid of cells and only refines the best few cells,
+        cells whose estimated lower likelihood bound is worse than the best value found get pruned
+        :param func: pointer to the likelihood calculaiton function
+        :param dimensions: number of dimensions
+        :param batch_func: optional pointer to a likelihood function that takes a matrix of parameters (one per row)
+        :param workers: number of worker processes every round gets spread to (None or 1 runs it in this process)
+        :param budget: optional OptiBudget, the search stops as soon as it is used up (with batch_func or workers after
+        the running round)
+        :return: the parameters of the best cell center
+        """
+        if budget is None:
+            budget = OptiBudget()
+        pool = None
+        if workers is not None and workers > 1:
+            pool = ProcessPoolExecutor(max_workers=workers)
+        try:
+            return self._adaptive_search(func, dimensions, batch_func, pool, workers, budget)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+    def _adaptive_search(self, func, dimensions, batch_func, pool, workers, budget):
+        lower = np.array([-5.] * dimensions + [1.] * dimensions)
+        upper = np.array([5.] * dimensions + [2.] * dimensions)
+        span = upper - lower
+        theta_sections = self.coarseThetaSections
+        p_sections = self.coarsePSections
+        # keep the coarse grid small in high dimensions, p is the less sensitive parameter
+        while (theta_sections * p_sections) ** dimensions > self.maxCoarsePoints and (theta_sections > 2 or p_sections > 1):
+            if p_sections > 1:
+                p_sections -= 1
+            else:
+                theta_sections -= 1
+        sections = np.array([theta_sections] * dimensions + [p_sections] * dimensions)
+        # the leaves of the search tree: cell centers, cell half widths and the likelihood at the centers
+        axes = [lower[i] + (np.arange(sections[i]) + 0.5) * span[i] / sections[i] for i in range(0, 2 * dimensions)]
+        centers = np.array(list(itertools.product(*axes)))
+        halfs = np.tile(span / (2. * sections), (len(centers), 1))
+        vals = self._eval_batch(func, batch_func, centers, budget, pool=pool, workers=workers)
+        evals = len(centers)
+        # estimated lipschitz constant of the likelihood (in coordinates scaled by span)
+        lipschitz = None
+        best_val = np.min(vals)
+        stalled = 0
+        for i_round in range(0, self.maxRounds):
+            if budget.exhausted():
+                break
+            order = np.argsort(vals)
+            if lipschitz is not None:
+                lower_bound = vals - lipschitz * np.linalg.norm(halfs / span, axis=1)
+                order = order[lower_bound[order] <= best_val]
+            refine = order[:self.keepCells]
+            # DIRECT like trisection: every refined cell gets two new centers along each of its longest axes
+            new_centers = []
+            new_parents = []
+            new_axes = []
+            for c in refine:
+                scaled = halfs[c] / span
+                for i in np.where(scaled >= scaled.max() * (1. - 1e-9))[0]:
+                    for sign in (-1., 1.):
+                        center = centers[c].copy()
+                        center[i] += sign * 2. / 3. * halfs[c][i]
+                        new_centers.append(center)
+                        new_parents.append(c)
+                        new_axes.append(i)
+            new_centers = np.array(new_centers)
+            new_parents = np.array(new_parents)
+            new_axes = np.array(new_axes)
+            new_vals = self._eval_batch(func, batch_func, new_centers, budget, pool=pool, workers=workers)
+            evals += len(new_centers)
+            # the cell is split into slabs one axis after the other, the axis with the best new value first,
+            # so the new cells and the shrunken cell still cover the old cell
+            new_halfs = np.zeros((len(new_centers), 2 * dimensions))
+            for c in refine:
+                children = np.where(new_parents == c)[0]
+                axes_vals = [(np.min(new_vals[children[new_axes[children] == i]]), i) for i in np.unique(new_axes[children])]
+                for _, i in sorted(axes_vals, key=lambda v: v[0]):
+                    halfs[c][i] /= 3.
+                    new_halfs[children[new_axes[children] == i]] = halfs[c]
+            finite = np.isfinite(new_vals) & np.isfinite(vals[new_parents])
+            if finite.any():
+                slopes = np.abs(new_vals[finite] - vals[new_parents][finite]) \
+                    / np.linalg.norm((new_centers[finite] - centers[new_parents][finite]) / span, axis=1)
+                lipschitz = max(lipschitz or 0., float(np.max(slopes)))
+            # pruned cells are dropped for good
+            keep = np.zeros(len(centers), dtype=bool)
+            keep[order] = True
+            centers = np.vstack((centers[keep], new_centers))
+            halfs = np.vstack((halfs[keep], new_halfs))
+            vals = np.concatenate((vals[keep], new_vals))
+            new_best = np.min(vals)
+            improvement = best_val - new_best
+            best_val = new_best
+            if improvement < self.adaptiveTol * max(1., abs(best_val)):
+                stalled += 1
+                if stalled >= self.adaptivePatience:
+                    break
+            else:
+                stalled = 0
+        if self.debug:
+            print('LikeliOptimizer adaptive search: {:d} rounds, {:d} evaluations'.format(i_round + 1, evals))
+        return list(centers[int(np.argmin(vals))])
+
+    @staticmethod
+    def _clean_vals(vals):
+        vals = np.array(vals, dtype=float)
+        vals[np.isnan(vals)] = float('inf')
+        return vals
+
+    def grid_params(self, dimensions, theta_sections, p_sections):
+        """
+        :return: matrix of all grid parameters [theta exponents, ps] in the order generate_grid walks them
+        """
+        ps = np.linspace(1., 2., num=p_sections)
+        thetas = np.linspace(-5, 5, num=theta_sections)
+        # like increase_i the first dimension changes fastest, p is the outer loop
+        t_idx = np.array(list(itertools.product(range(len(thetas)), repeat=dimensions)))[:, ::-1]
+        p_idx = np.array(list(itertools.product(range(len(ps)), repeat=dimensions)))[:, ::-1]
+        return np.hstack((np.tile(thetas[t_idx], (len(p_idx), 1)), np.repeat(ps[p_idx], len(t_idx), axis=0)))
+
     def increase_i(self, i_list, max_len):
         for i in range(0, len(i_list)):
             # -1 here because we start indexing at 0
@@ -95,3 +356,15 @@ class LikeliOptimizer:
                 i_list[i] += 1
                 return i_list
         return i_list
+
+
+class PointBatch:
+    """
+    batch function that evaluates a likelihood function point by point (module level so it can be sent to worker processes)
+    """
+
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, params):
+        return np.array([self.func(list(param)) for param in params])
@@ -0,0 +1,175 @@
+__author__ = "Juri Bieler"
+__version__ = "0.0.1"
+__email__ = "juribieler@gmail.com"
+__status__ = "Development"
+
+# ==============================================================================
+# description     :parallel multi-start Optimizer for the Kriging likelihood
+# date            :2018-07-23
+# version         :0.01
+# notes           :
+# python_version  :3.6
+# ==============================================================================
+
+
+from concurrent.futures import ProcessPoolExecutor
+from scipy.optimize import minimize
+from timeit import default_timer as timer
+import numpy as np
+
+from mylibs.halton import Halton
+from mylibs.opti_budget import OptiBudget
+from mylibs.opti_budget import BudgetExceeded
+
+
+class MultiStartOptimizer:
+
+    def __init__(self, starts=32, workers=None, seed=0, method='SLSQP', converge_count=3, converge_tol=1e-6,
+                 x_tol=1e-2, check_every=8, debug=False):
+        """
+        :param starts: maximum number of local searches
+        :param workers: number of worker processes (None or 1 runs everything in this process)
+        :param seed: seed of the random number streams (every start gets its own stream)
+        :param method: local optimizer ('SLSQP' or 'L-BFGS-B')
+        :param converge_count: stop early if this many starts found the same minimum
+        :param converge_tol: relative tolerance for the likelihood of two minima to count as the same
+        :param x_tol: tolerance (relative to the bounds) for the parameters of two minima to count as the same,
+        a search that moved less than this from its start did not converge at all (e.g. on a flat plateau)
+        :param check_every: number of starts between two convergence checks (independent of workers, so the result
+        does not depend on the number of worker processes)
+        :param debug: print some information about the search
+        """
+        self.debug = debug
+        self.pBounds = (1., 2.)
+        self.thetaBoundsExp = (-5., 5.)
+        self.maxIter = 5e3
+        self.starts = starts
+        self.workers = workers if workers is not None else 1
+        self.seed = seed
+        self.method = method
+        self.converge_count = converge_count
+        self.converge_tol = converge_tol
+        self.x_tol = x_tol
+        self.check_every = check_every
+
+    def find(self, func, dimensions, jac=None, budget=None):
+        """
+        finds the min neg. log. likelihood by independent local searches from a space filling set of starts
+        :param func: pointer to the likelihood calculaiton function (must be picklable if workers > 1)
+        :param dimensions: number of dimensions
+        :param jac: optional pointer to the gradient of func
+        :param budget: optional OptiBudget, every local search stops as soon as the remaining time or its share of
+        the remaining evaluations is used up
+        :return: the best minimum as a scipy.optimize.minimize result
+        """
+        if budget is None:
+            budget = OptiBudget()
+        budget.start_phase('multi-start')
+        bnds = [self.thetaBoundsExp] * dimensions + [self.pBounds] * dimensions
+        starts = self.generate_starts(dimensions, bnds)
+        results = []
+        pool = None
+        if self.workers > 1:
+            pool = ProcessPoolExecutor(max_workers=self.workers)
+        try:
+            # run the starts in waves of check_every starts to be able to stop early
+            for i in range(0, len(starts), self.check_every):
+                if budget.exhausted() and len(results) > 0:
+                    break
+                wave = starts[i:i + self.check_every]
+                if pool is None:
+                    for x0 in wave:
+                        if budget.exhausted() and len(results) > 0:
+                            break
+                        res = _local_search(func, jac, x0, bnds, self.method, self.maxIter, self._limits(budget, 1))
+                        budget.record([res.x], [res.fun], evals=res.nfev)
+                        results.append(res)
+                else:
+                    limits = self._limits(budget, len(wave))
+                    futures = [pool.submit(_local_search, func, jac, x0, bnds, self.method, self.maxIter, limits)
+                               for x0 in wave]
+                    results += [f.result() for f in futures]
+                    for res in results[-len(wave):]:
+                        budget.record([res.x], [res.fun], evals=res.nfev)
+                if self.count_converged(results) >= self.converge_count:
+                    break
+        finally:
+            if pool is not None:
+                pool.shutdown()
+            budget.end_phase()
+        best_res = min(results, key=lambda r: r.fun if np.isfinite(r.fun) else float('inf'))
+        best_res.nstarts = len(results)
+        if self.debug:
+            print('MultiStartOptimizer: {:d} local searches, {:d} at the best minimum'.format(len(results),
+                                                                                         self.count_converged(results)))
+        return best_res
+
+    @staticmethod
+    def _limits(budget, searches):
+        """
+        :param budget: OptiBudget of the whole search
+        :param searches: number of local searches sharing the remaining evaluations
+        :return: (deadline in timer seconds or None, evaluations per local search or None)
+        """
+        remaining_time = budget.remaining_time()
+        remaining_evals = budget.remaining_evals()
+        deadline = None if remaining_time is None else timer() + remaining_time
+        evals = None if remaining_evals is None else max(1, -(-remaining_evals // searches))
+        return deadline, evals
+
+    def generate_starts(self, dimensions, bnds):
+        """
+        halton points, each one shifted randomly inside its cell by its own seeded random stream
+        :param dimensions: number of dimensions
+        :param bnds: list of bounds (tuples) for every parameter
+        :return: matrix with one start point per row
+        """
+        starts = np.array(Halton().generate_sample_plan(self.starts, 2 * dimensions, bnds))
+        lower = np.array([b[0] for b in bnds])
+        upper = np.array([b[1] for b in bnds])
+        cell = (upper - lower) / (self.starts ** (1. / (2 * dimensions)))
+        streams = np.random.SeedSequence(self.seed).spawn(self.starts)
+        for i in range(0, self.starts):
+            rng = np.random.default_rng(streams[i])
+            starts[i] += rng.uniform(-0.5, 0.5, 2 * dimensions) * cell
+        return np.clip(starts, lower, upper)
+
+    def count_converged(self, results):
+        """
+        :param results: list of scipy.optimize.minimize results (with the start point x0)
+        :return: number of results that moved away from their start and found the current best minimum
+        """
+        if len(results) == 0:
+            return 0
+        funs = np.array([r.fun for r in results], dtype=float)
+        xs = np.array([r.x for r in results], dtype=float)
+        dimensions = xs.shape[1] // 2
+        span = np.array([self.thetaBoundsExp[1] - self.thetaBoundsExp[0]] * dimensions
+                        + [self.pBounds[1] - self.pBounds[0]] * dimensions)
+        moved = np.array([np.max(np.abs(r.x - r.x0) / span) > self.x_tol for r in results])
+        valid = np.isfinite(funs) & moved
+        if not valid.any():
+            return 0
+        i_best = np.where(valid)[0][np.argmin(funs[valid])]
+        same_fun = np.abs(funs - funs[i_best]) <= self.converge_tol * max(1., abs(funs[i_best]))
+        same_x = np.max(np.abs(xs - xs[i_best]) / span, axis=1) <= self.x_tol
+        return int(np.sum(valid & same_fun & same_x))
+
+
+def _local_search(func, jac, x0, bnds, method, max_iter, limits=(None, None)):
+    """
+    one local search, module level so it can be sent to worker processes
+    :param limits: (deadline, evaluations) from MultiStartOptimizer._limits, the search returns its best point once
+    they are used up
+    :return: scipy.optimize.minimize result
+    """
+    opt = {'disp': False, 'maxiter': max_iter}
+    budget = OptiBudget(max_time=None if limits[0] is None else max(0., limits[0] - timer()), max_evals=limits[1])
+    try:
+        res = minimize(budget.wrap(func), x0, method=method, jac=jac, tol=1e-8, options=opt, bounds=bnds)
+    except BudgetExceeded:
+        res = budget.result()
+        if res.x is None:
+            res.x = np.array(x0, dtype=float)
+    res.x0 = np.array(x0, dtype=float)
+    return res
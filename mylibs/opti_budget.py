@@ -0,0 +1,134 @@
+__author__ = "Juri Bieler"
+__version__ = "0.0.1"
+__email__ = "juribieler@gmail.com"
+__status__ = "Development"
+
+# ==============================================================================
+# description     :time and evaluation budget for the likelihood optimizers
+# date            :2018-07-23
+# version         :0.01
+# notes           :
+# python_version  :3.6
+# ==============================================================================
+
+
+from scipy.optimize import OptimizeResult
+import numpy as np
+
+from myutils.time_track import TimeTrack
+
+
+class BudgetExceeded(Exception):
+    pass
+
+
+class OptiBudget:
+
+    def __init__(self, max_time=None, max_evals=None):
+        """
+        tracks the evaluations of an optimization, keeps the best point found so far and reports per phase
+        :param max_time: wall clock budget in seconds (None for no limit)
+        :param max_evals: maximum number of likelihood evaluations (None for no limit)
+        """
+        self.max_time = max_time
+        self.max_evals = max_evals
+        self.evals = 0
+        self.best_val = float('inf')
+        self.best_param = None
+        self.budget_hit = False
+        self.phase_times = {}
+        self.phase_evals = {}
+        self._phase = None
+        self._phase_evals_start = 0
+        self._timer = TimeTrack('budgetTimer')
+        self._phase_timer = TimeTrack('phaseTimer')
+
+    def start_phase(self, name):
+        """
+        starts timing of a new phase (the running phase gets closed)
+        :param name: name of the phase (e.g. 'grid', 'polish')
+        :return: None
+        """
+        self.end_phase()
+        self._phase = name
+        self._phase_evals_start = self.evals
+        self._phase_timer.tic()
+
+    def end_phase(self):
+        if self._phase is None:
+            return
+        self.phase_times[self._phase] = self.phase_times.get(self._phase, 0.) + self._phase_timer.toc()
+        self.phase_evals[self._phase] = self.phase_evals.get(self._phase, 0) + self.evals - self._phase_evals_start
+        self._phase = None
+
+    def remaining_evals(self):
+        if self.max_evals is None:
+            return None
+        return max(0, self.max_evals - self.evals)
+
+    def remaining_time(self):
+        if self.max_time is None:
+            return None
+        return max(0., self.max_time - self._timer.get_time())
+
+    def exhausted(self):
+        """
+        :return: True if the time or the evaluation budget is used up (sets budget_hit)
+        """
+        if self.max_time is not None and self._timer.get_time() >= self.max_time:
+            self.budget_hit = True
+        if self.max_evals is not None and self.evals >= self.max_evals:
+            self.budget_hit = True
+        return self.budget_hit
+
+    def record(self, params, vals, evals=None):
+        """
+        counts evaluations and remembers the best one
+        :param params: matrix of evaluated parameters (one per row)
+        :param vals: list of results
+        :param evals: number of evaluations to count (if None one per result)
+        :return: None
+        """
+        vals = np.array(vals, dtype=float).flatten()
+        self.evals += len(vals) if evals is None else evals
+        if len(vals) == 0:
+            return
+        vals = np.where(np.isnan(vals), float('inf'), vals)
+        i_min = int(np.argmin(vals))
+        if vals[i_min] < self.best_val:
+            self.best_val = vals[i_min]
+            self.best_param = np.array(params, dtype=float).reshape((len(vals), -1))[i_min]
+
+    def wrap(self, func):
+        """
+        :param func: likelihood function of one parameter vector
+        :return: counting function that raises BudgetExceeded once the budget is used up
+        """
+        return BudgetFunc(self, func)
+
+    def result(self):
+        """
+        :return: the best point so far as a scipy.optimize.minimize like result
+        """
+        return OptimizeResult(x=self.best_param, fun=self.best_val, nit=0, nfev=self.evals,
+                              success=False, message='optimization budget exhausted')
+
+    def summary(self):
+        lines = ['likelihood evaluations: {:d}, budget hit: {:s}'.format(self.evals, str(self.budget_hit))]
+        for phase in self.phase_times:
+            lines.append('  {:s}: {:f} s, {:d} evaluations'.format(phase, self.phase_times[phase], self.phase_evals[phase]))
+        return '\n'.join(lines)
+
+
+class BudgetFunc:
+
+    def __init__(self, budget, func):
+        self.budget = budget
+        self.func = func
+
+    def __call__(self, params, *args):
+        if self.budget.exhausted():
+            raise BudgetExceeded()
+        val = self.func(params, *args)
+        self.budget.record([params], [val])
+        return val
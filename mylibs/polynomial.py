@@ -14,10 +14,13 @@ __status__ = "Development"
 
 import numpy as np
 
+from mylibs.batch_predictor import BatchPredictor
+from mylibs.batch_predictor import PREDICT_CHUNK
+
 VARS = ['x', 'y', 'z']
 
 
-class Polynomial:
+class Polynomial(BatchPredictor):
 
     def __init__(self, known_in, known_val):
         """
@@ -31,6 +34,8 @@ class Polynomial:
         self._k = self._known_in.shape[1]
         self._n = self._known_in.shape[0]
         self._order = 2
+        # exponents of the inputs in every polynomial term (terms x k)
+        self._exponents = None
 
     def train(self):
         """
@@ -49,42 +54,16 @@ class Polynomial:
         self._calc_vandermonde_mat()
         self._calc_weights()
 
-    def _calc_term_count(self):
-        iw = 1
-        for o in range(1, self._order + 1):
-            for ik in range(0, self._k):
-                iw += 1
-                for ikc in range(0, self._k):
-                    if ikc > ik and 2 * o < self._order + 1:
-                        iw += 1
-                    if ikc != ik:
-                        for ioc in range(1, min(o, (self._order + 1) - o)):
-                            iw += 1
-        return iw
-
     def _calc_vandermonde_mat(self):
-        vander = np.zeros((self._n, self._calc_term_count()))
-        for i in range(0, self._n):
-            iw = 0
-            vander[i][iw] = 1
-            iw += 1
-            for o in range(1, self._order+1):
-                for ik in range(0, self._k):
-                    vander[i][iw] = self._known_in[i][ik] ** o
-                    iw += 1
-                    for ikc in range(0, self._k):
-                        if ikc > ik and 2*o < self._order+1:
-                            vander[i][iw] = (self._known_in[i][ik] ** o) * (self._known_in[i][ikc] ** o)
-                            iw += 1
-                        if ikc != ik:
-                            for ioc in range(1, min(o, (self._order+1)-o)):
-                                vander[i][iw] = (self._known_in[i][ik] ** o) * (self._known_in[i][ikc] ** ioc)
-                                iw += 1
-        # delete unused columns
-        for i in range(0, self._calc_term_count() - iw):
-            vander = np.delete(vander, -1, axis=1)
-            print('KICK OUT')
-        self._vander = vander
+        self._exponents = calc_exponents(self._order, self._k)
+        self._vander = self.calc_vandermonde(self._known_in)
+
+    def calc_vandermonde(self, x):
+        """
+        :param x: matrix of input values (m x k)
+        :return: matrix with the value of every polynomial term at every point (m x terms)
+        """
+        return np.prod(x[:, np.newaxis, :] ** self._exponents[np.newaxis, :, :], axis=2)
 
     def _calc_weights(self):
         # moore-penrose pseudo-inverse
@@ -92,49 +71,25 @@ class Polynomial:
         weights = pin_vander @ self._known_val
         self._weights = weights
 
-    def predict(self, x_pred):
+    def predict_batch(self, x_pred, chunk_size=PREDICT_CHUNK):
         """
-        predicts a value from the surrogate model
-        :param x_pred: vector of input values
-        :return: result value
+        predicts the values of many points at once, the points are processed in chunks to bound the memory usage
+        :param x_pred: matrix of input values (m x k)
+        :param chunk_size: number of points per chunk
+        :return: array of m result values
         """
-        fx = 0.
-        iw = 0
-        fx += self._weights[iw]
-        iw += 1
-        for o in range(1, self._order + 1):
-            for ik in range(0, self._k):
-                fx += self._weights[iw] * x_pred[ik] ** o
-                iw += 1
-                for ikc in range(0, self._k):
-                    if ikc > ik and 2 * o < self._order + 1:
-                        fx += self._weights[iw] * (x_pred[ik]**o) * (x_pred[ikc]**o)
-                        iw += 1
-                    if ikc != ik:
-                        for ioc in range(1, min(o, (self._order + 1) - o)):
-                            fx += self._weights[iw] * (x_pred[ik]**o) * (x_pred[ikc]**ioc)
-                            iw += 1
+        x_pred = np.asarray(x_pred, dtype=float).reshape((-1, self._k))
+        fx = np.empty(x_pred.shape[0])
+        for i in range(0, x_pred.shape[0], chunk_size):
+            fx[i:i + chunk_size] = self.calc_vandermonde(x_pred[i:i + chunk_size]) @ self._weights
         return fx
 
     def generate_formula(self):
         str_print = ''
-        iw = 0
-        str_print += '{:f}'.format(self._weights[iw])
-        iw += 1
-        for o in range(1, self._order + 1):
-            for ik in range(0, self._k):
-                str_print += ' + {:f} * {:s}^({:d})'.format(self._weights[iw], VARS[ik], o)
-                iw += 1
-                for ikc in range(0, self._k):
-                    if ikc > ik and 2 * o < self._order + 1:
-                        str_print += ' + {:f} * {:s}^({:d}) * {:s}^({:d})'.format(self._weights[iw], VARS[ik], o, VARS[ikc], o)
-                        iw += 1
-                    if ikc != ik:
-                        for ioc in range(1, min(o, (self._order + 1) - o)):
-                            str_print += ' + {:f} * {:s}^({:d}) * {:s}^({:d})'.format(self._weights[iw], VARS[ik], o, VARS[ikc],
-                                                                            ioc)
-                            iw += 1
-        str_print = str_print.replace('+ -', '- ')
+        for iw in range(0, len(self._exponents)):
+            factors = ['{:s}^({:d})'.format(VARS[ik], e) for ik, e in enumerate(self._exponents[iw]) if e > 0]
+            str_print += ' + ' + ' * '.join(['{:f}'.format(self._weights[iw])] + factors)
+        str_print = str_print[3:].replace('+ -', '- ')
         print(str_print)
         return str_print
 
@@ -143,3 +98,31 @@ class Polynomial:
 
     def get_weights(self):
         return self._weights
+
+
+def calc_exponents(order, k):
+    """
+    term structure of the polynomial: constant, all pure powers up to order and the mixed terms of two inputs
+    x_i^o * x_j^o (2 * o <= order) and x_i^o * x_j^oc (oc < min(o, order + 1 - o))
+    :param order: the maximum polynomial order
+    :param k: number of inputs
+    :return: integer matrix with the exponent of every input in every term (terms x k)
+    """
+    exponents = [np.zeros(k, dtype=int)]
+    for o in range(1, order + 1):
+        for ik in range(0, k):
+            term = np.zeros(k, dtype=int)
+            term[ik] = o
+            exponents.append(term)
+            for ikc in range(0, k):
+                if ikc > ik and 2 * o < order + 1:
+                    term = np.zeros(k, dtype=int)
+                    term[[ik, ikc]] = o
+                    exponents.append(term)
+                if ikc != ik:
+                    for ioc in range(1, min(o, (order + 1) - o)):
+                        term = np.zeros(k, dtype=int)
+                        term[ik] = o
+                        term[ikc] = ioc
+                        exponents.append(term)
+    return np.array(exponents)
@@ -0,0 +1,140 @@
+__author__ = "Juri Bieler"
+__version__ = "0.0.1"
+__email__ = "juribieler@gmail.com"
+__status__ = "Development"
+
+# ==============================================================================
+# description     :n-dimensional partition of unity RadialBasisFunction for large sample counts
+# date            :2018-07-23
+# version         :0.01
+# notes           :
+# python_version  :3.6
+# ==============================================================================
+
+from concurrent.futures import ProcessPoolExecutor
+import os
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from mylibs.batch_predictor import BatchPredictor
+from mylibs.batch_predictor import PREDICT_CHUNK
+from mylibs.rbf import RBF
+from mylibs.rbf import wendland_rbf
+
+# aimed number of sample points per patch
+PATCH_POINTS = 50
+# radius of the patches relative to the half diagonal of their cell (> 1 so neighbouring patches overlap)
+OVERLAP = 1.5
+# min number of sample points of a patch, sparse patches take the nearest points
+MIN_PATCH_POINTS = 5
+
+
+class PURBF(BatchPredictor):
+
+    def __init__(self, known_in, known_val, patch_points=PATCH_POINTS, overlap=OVERLAP, workers=1):
+        """
+        the domain is covered by overlapping patches on a regular grid, every patch gets its own small RBF and
+        predict blends the RBFs of the patches covering a point with wendland weights (shepard normalized)
+        :param known_in: list of lists with input sample points
+        :param known_val: list of results for the known_in
+        :param patch_points: aimed number of sample points per patch
+        :param overlap: radius of the patches relative to the half diagonal of their cell
+        :param workers: number of worker processes fitting the patches (None uses all cpus, 1 fits in this process)
+        """
+        self._known_in = np.array(known_in, dtype=float)
+        self._known_val = np.array(known_val, dtype=float).flatten()
+        if len(self._known_in.shape) == 1:
+            self._known_in = self._known_in.reshape((self._known_in.shape[0], 1))
+        self._k = self._known_in.shape[1]
+        self._n = self._known_in.shape[0]
+        self.workers = workers if workers is not None else os.cpu_count()
+        self._rbf_const = 1.
+        self._rbf_name = 'gaus'
+        # the patch centers form a regular grid over the bounding box of the samples
+        lower = self._known_in.min(axis=0)
+        upper = self._known_in.max(axis=0)
+        cells = max(1, int(np.ceil((self._n / patch_points) ** (1. / self._k))))
+        cell_size = np.maximum((upper - lower) / cells, 1e-12)
+        axes = [lower[d] + cell_size[d] * (np.arange(0, cells) + 0.5) for d in range(0, self._k)]
+        self._centers = np.array([m.flatten() for m in np.meshgrid(*axes, indexing='ij')]).T
+        self._radius = overlap * 0.5 * np.linalg.norm(cell_size)
+        self._center_tree = cKDTree(self._centers)
+        # sample point indices of every patch
+        known_tree = cKDTree(self._known_in)
+        self._patch_indices = []
+        for c in range(0, len(self._centers)):
+            indices = np.array(known_tree.query_ball_point(self._centers[c], self._radius), dtype=int)
+            if len(indices) < MIN_PATCH_POINTS:
+                _, indices = known_tree.query(self._centers[c], k=min(MIN_PATCH_POINTS, self._n))
+            self._patch_indices.append(np.sort(np.atleast_1d(indices)))
+        # one RBF per patch
+        self._patches = None
+
+    def train(self):
+        """
+        trains the surrogate if available
+        :return: None
+        """
+        pass
+
+    def update_param(self, rbf_const, rbf_name):
+        """
+        updates the parameters of the surrogate model, all patches get fitted again
+        :param rbf_const: the rbf constant a
+        :param rbf_name: the short name of the rbf to use (see RBF.update_param)
+        :return: None
+        """
+        self._rbf_const = rbf_const
+        self._rbf_name = rbf_name
+        jobs = [(self._known_in[ind], self._known_val[ind], rbf_const, rbf_name) for ind in self._patch_indices]
+        if self.workers > 1:
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                self._patches = list(pool.map(_fit_patch, *zip(*jobs),
+                                              chunksize=max(1, len(jobs) // (4 * self.workers))))
+        else:
+            self._patches = [_fit_patch(*job) for job in jobs]
+
+    def predict_batch(self, x_pred, chunk_size=PREDICT_CHUNK):
+        """
+        predicts the values of many points at once, every point only uses the patches that cover it
+        (points outside of all patches use the nearest one)
+        :param x_pred: matrix of input values (m x k)
+        :param chunk_size: number of points per chunk
+        :return: array of m result values
+        """
+        x_pred = np.asarray(x_pred, dtype=float).reshape((-1, self._k))
+        fx = np.empty(x_pred.shape[0])
+        for i in range(0, x_pred.shape[0], chunk_size):
+            chunk = x_pred[i:i + chunk_size]
+            covering = self._center_tree.query_ball_point(chunk, self._radius)
+            _, nearest = self._center_tree.query(chunk)
+            rows = np.repeat(np.arange(0, chunk.shape[0]), [len(cov) for cov in covering])
+            patch_ids = np.concatenate([np.array(cov, dtype=int) for cov in covering])
+            weight_sum = np.zeros(chunk.shape[0])
+            val_sum = np.zeros(chunk.shape[0])
+            for p in np.unique(patch_ids):
+                q = rows[patch_ids == p]
+                weights = wendland_rbf(self._radius, np.linalg.norm(chunk[q] - self._centers[p], axis=1))
+                weight_sum[q] += weights
+                val_sum[q] += weights * self._patches[p].predict_batch(chunk[q])
+            outside = weight_sum <= 0.
+            for p in np.unique(nearest[outside]):
+                q = np.where(outside & (nearest == p))[0]
+                val_sum[q] = self._patches[p].predict_batch(chunk[q])
+                weight_sum[q] = 1.
+            fx[i:i + chunk_size] = val_sum / weight_sum
+        return fx
+
+    def get_patch_count(self):
+        return len(self._centers)
+
+
+def _fit_patch(known_in, known_val, rbf_const, rbf_name):
+    """
+    fits the RBF of one patch, module level so it can be sent to worker processes
+    :return: RBF instance
+    """
+    patch = RBF(known_in, known_val)
+    patch.update_param(rbf_const, rbf_name)
+    return patch
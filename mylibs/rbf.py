@@ -13,10 +13,25 @@ __status__ = "Development"
 
 
 import numpy as np
-import math
+from scipy.spatial.distance import pdist, squareform, cdist
+from scipy.spatial import cKDTree
+from scipy import sparse
+from scipy.sparse.linalg import splu
+from scipy.linalg import lapack
+from scipy.linalg import cho_solve
+from scipy.linalg import solve_triangular
+from scipy.optimize import minimize_scalar
 
+from mylibs.batch_predictor import BatchPredictor
+from mylibs.batch_predictor import PREDICT_CHUNK
 
-class RBF:
+# number of log spaced candidates of the coarse search in optimize
+OPTI_GRID = 30
+# max residual of fit_greedy relative to the range of the results
+GREEDY_TOL = 1e-3
+
+
+class RBF(BatchPredictor):
 
     def __init__(self, known_in, known_val):
         """
@@ -32,6 +47,19 @@ class RBF:
         self._coeff = None
         self._rbf_const = 1.
         self._rbf = gaus_rbf
+        self._rbf_name = 'gaus'
+        # interpolation matrix and its cholesky factor (None if it is not positive definite)
+        self._mat = None
+        self._mat_chol = None
+        # sparse lu factorization of the interpolation matrix of compactly supported rbfs
+        self._mat_lu = None
+        # euclidean distances between the known points (n x n), they do not depend on the rbf parameters,
+        # built on first use since compactly supported rbfs only need the kd-tree
+        self._radial_mat = None
+        self._tree = None
+        # the centers of the rbfs, all known points unless fit_greedy selected a subset
+        self._centers = self._known_in
+        self._center_tree = None
 
     def train(self):
         """
@@ -48,6 +76,15 @@ class RBF:
         :return: None
         """
         self._rbf_const = rbf_const
+        self._set_rbf(rbf_name)
+        self._calc_coefficiants()
+
+    def _set_rbf(self, rbf_name):
+        """
+        :param rbf_name: the short name of the rbf to use (lin. gaus, mq, imq, wendland)
+        :return: None
+        """
+        self._rbf_name = rbf_name
         if rbf_name == 'lin':
             self._rbf = lin_rbf
         elif rbf_name == 'cubic':
@@ -58,49 +95,201 @@ class RBF:
             self._rbf = multi_quad_rbf
         elif rbf_name == 'inverse-multi-quadratic' or rbf_name == 'imq':
             self._rbf = inv_multi_quad_rbf
+        elif rbf_name == 'wendland' or rbf_name == 'wend':
+            self._rbf = wendland_rbf
         else:
             print('WARNING: unknown rbf_name (' + rbf_name + '), I will just use gaus for you.')
-            print('next time chose one of ["gaus", "multi-quadratic", "inverse-multi-quadratic"]')
+            print('next time chose one of ["gaus", "multi-quadratic", "inverse-multi-quadratic", "wendland"]')
             self._rbf = gaus_rbf
-        self._calc_coefficiants()
 
     def _calc_coefficiants(self):
-        mat = np.zeros((self._n, self._n))
-        radial_mat = np.zeros((self._n, self._n))
-        for i in range(0, self._n):
-            for j in range(i, self._n):
-                radSum = 0.
-                for ik in range(0, self._k):
-                    radSum += (self._known_in[i][ik] - self._known_in[j][ik]) ** 2.
-                radius = math.sqrt(radSum)
-                radial_mat[i][j] = radius
-                mat[i][j] = self._rbf(self._rbf_const, radius)
-                mat[j][i] = mat[i][j]
-        self._coeff = np.linalg.solve(mat, self._known_val)
+        self._mat_chol = None
+        self._mat_lu = None
+        self._centers = self._known_in
+        if self._rbf in COMPACT_RBFS:
+            return self._calc_coefficiants_sparse()
+        if self._radial_mat is None:
+            self._radial_mat = squareform(pdist(self._known_in))
+        self._mat = self._rbf(self._rbf_const, self._radial_mat)
+        if self._rbf in POS_DEF_RBFS:
+            # lapack potrf reports a not positive definite matrix by its info flag, then the general solver is used
+            chol, info = lapack.dpotrf(self._mat, lower=1, clean=1)
+            if info == 0:
+                self._mat_chol = chol
+                self._coeff = cho_solve((chol, True), self._known_val, check_finite=False)
+                return self._coeff
+        self._coeff = np.linalg.solve(self._mat, self._known_val)
         return self._coeff
 
-    def get_coeff(self):
+    def _calc_coefficiants_sparse(self):
+        """
+        the rbf constant a is the support radius, only pairs of points closer than a (kd-tree) get an entry
+        in the sparse interpolation matrix, it is solved by a sparse lu factorization
+        """
+        if self._tree is None:
+            self._tree = cKDTree(self._known_in)
+        self._center_tree = self._tree
+        pairs = self._tree.query_pairs(self._rbf_const, output_type='ndarray')
+        vals = self._rbf(self._rbf_const, np.linalg.norm(self._known_in[pairs[:, 0]] - self._known_in[pairs[:, 1]], axis=1))
+        diag = np.arange(0, self._n)
+        self._mat = sparse.csc_matrix((np.concatenate((vals, vals, self._rbf(self._rbf_const, np.zeros(self._n)))),
+                                       (np.concatenate((pairs[:, 0], pairs[:, 1], diag)),
+                                        np.concatenate((pairs[:, 1], pairs[:, 0], diag)))),
+                                      shape=(self._n, self._n))
+        # minimum degree ordering on A^T A keeps the fill-in of the symmetric matrix lowest
+        self._mat_lu = splu(self._mat, permc_spec='MMD_ATA', options=dict(SymmetricMode=True))
+        self._coeff = self._mat_lu.solve(np.asarray(self._known_val, dtype=float))
         return self._coeff
 
-    def predict(self, x_pred):
+    def calc_loo_errors(self):
         """
-        predicts a value from the surrogate model
-        :param x_pred: vector of input values
-        :return: result value
+        leave-one-out errors of all sample points in closed form (rippa): e_i = c_i / (A^-1)_ii
+        :return: vector of the errors y_i - f_-i(x_i) (n)
         """
-        res = 0.
-        for i in range(0, self._n):
-            rad_sum = 0.
-            for ik in range(0, self._k):
-                rad_sum += (x_pred[ik] - self._known_in[i][ik]) ** 2.
-            radius = math.sqrt(rad_sum)
-            res += self._coeff[i] * self._rbf(self._rbf_const, radius)
+        if self._mat is None:
+            raise Exception('ERROR: leave-one-out errors need a model with all known points as centers (update_param)')
+        if self._mat_chol is not None:
+            # (A^-1)_ii is the squared norm of column i of L^-1
+            inv_chol = solve_triangular(self._mat_chol, np.eye(self._n), lower=True, check_finite=False)
+            inv_diag = np.sum(inv_chol ** 2, axis=0)
+        elif self._mat_lu is not None:
+            # columns of A^-1 in chunks, so only chunk x n values are held at once
+            inv_diag = np.empty(self._n)
+            for i in range(0, self._n, PREDICT_CHUNK):
+                cols = np.arange(i, min(i + PREDICT_CHUNK, self._n))
+                unit = np.zeros((self._n, len(cols)))
+                unit[cols, np.arange(0, len(cols))] = 1.
+                inv_diag[cols] = self._mat_lu.solve(unit)[cols, np.arange(0, len(cols))]
+        else:
+            inv_diag = np.diag(np.linalg.inv(self._mat))
+        return self._coeff / inv_diag
+
+    def _calc_loo_rmse(self, rbf_const, rbf_name):
         try:
-            r = res.item()
-            res = r
-        except:
-            pass
-        return res
+            self.update_param(rbf_const, rbf_name)
+            rmse = np.sqrt(np.mean(self.calc_loo_errors() ** 2))
+        except np.linalg.LinAlgError:
+            return float('inf')
+        return rmse if np.isfinite(rmse) else float('inf')
+
+    def optimize(self, rbf_name=None, bounds=(0.01, 5.)):
+        """
+        finds the rbf constant a with the smallest leave-one-out rmse, no validation points are needed,
+        log spaced candidates first, then a bounded search between the neighbours of the best one
+        :param rbf_name: the short name of the rbf to use (None keeps the current one)
+        :param bounds: range of a
+        :return: the best rbf constant a
+        """
+        if rbf_name is None:
+            rbf_name = self._rbf_name
+        consts = np.logspace(np.log10(bounds[0]), np.log10(bounds[1]), OPTI_GRID)
+        rmses = [self._calc_loo_rmse(a, rbf_name) for a in consts]
+        i_best = int(np.argmin(rmses))
+        res = minimize_scalar(self._calc_loo_rmse, args=(rbf_name,), method='bounded',
+                              bounds=(consts[max(i_best - 1, 0)], consts[min(i_best + 1, OPTI_GRID - 1)]))
+        best_const = res.x if res.fun < rmses[i_best] else consts[i_best]
+        self.update_param(best_const, rbf_name)
+        return best_const
+
+    def fit_greedy(self, rbf_const, rbf_name, tol=GREEDY_TOL, max_centers=None):
+        """
+        compact model: starting with one center, the known point with the largest residual becomes the next center
+        until all residuals are below tol, as long as the center matrix stays positive definite its cholesky factor
+        is extended by one row per step, afterwards (or for rbfs that are not positive definite) the coefficients
+        come from a least squares solve of the center matrix
+        :param rbf_const: the rbf constant a
+        :param rbf_name: the short name of the rbf to use (see update_param)
+        :param tol: max residual relative to the range of the results
+        :param max_centers: max number of centers (None for no limit)
+        :return: indices of the selected centers
+        """
+        self._rbf_const = rbf_const
+        self._set_rbf(rbf_name)
+        known_val = np.asarray(self._known_val, dtype=float)
+        max_centers = self._n if max_centers is None else min(max_centers, self._n)
+        max_res = tol * max(np.ptp(known_val), 1e-12)
+        phi_0 = self._rbf(self._rbf_const, 0.)
+        selected = [int(np.argmax(np.abs(known_val - np.mean(known_val))))]
+        # rbf values between all known points and the centers (n x m)
+        cor_nm = self._rbf(self._rbf_const, cdist(self._known_in, self._known_in[selected]))
+        # cholesky factor of the center matrix and L^-1 y of the centers (None once the matrix is not pos. definite)
+        chol = None
+        chol_inv_val = None
+        if phi_0 > 0.:
+            chol = np.array([[np.sqrt(phi_0)]])
+            chol_inv_val = np.array([known_val[selected[0]] / chol[0, 0]])
+        while True:
+            if chol is not None:
+                coeff = solve_triangular(chol, chol_inv_val, lower=True, trans='T', check_finite=False)
+            else:
+                coeff = np.linalg.lstsq(cor_nm[selected], known_val[selected], rcond=None)[0]
+            res = np.abs(known_val - cor_nm @ coeff)
+            candidates = res.copy()
+            candidates[selected] = -1.
+            i_new = int(np.argmax(candidates))
+            if np.max(res) <= max_res or len(selected) >= max_centers or candidates[i_new] < 0.:
+                break
+            cor_new = self._rbf(self._rbf_const, cdist(self._known_in, self._known_in[[i_new]]))
+            if chol is not None:
+                # [[L, 0], [l^T, d]] with l = L^-1 k and d^2 = phi(0) - l^T l
+                chol_row = solve_triangular(chol, cor_new[selected, 0], lower=True, check_finite=False)
+                diag_sqr = phi_0 - chol_row @ chol_row
+                if diag_sqr > 1e-12 * phi_0:
+                    m = len(selected)
+                    chol = np.block([[chol, np.zeros((m, 1))], [chol_row[np.newaxis, :], np.array([[np.sqrt(diag_sqr)]])]])
+                    chol_inv_val = np.append(chol_inv_val, (known_val[i_new] - chol_row @ chol_inv_val) / chol[m, m])
+                else:
+                    # the center matrix is not (numerically) positive definite anymore
+                    chol = None
+                    chol_inv_val = None
+            selected.append(i_new)
+            cor_nm = np.column_stack((cor_nm, cor_new))
+        if np.max(res) > max_res:
+            print('WARNING: fit_greedy stopped at {:d} centers with max residual {:f} (tol: {:f})'.format(
+                len(selected), np.max(res), max_res))
+        self._centers = self._known_in[selected]
+        self._coeff = coeff
+        self._center_tree = cKDTree(self._centers) if self._rbf in COMPACT_RBFS else None
+        self._mat = None
+        self._mat_chol = None
+        self._mat_lu = None
+        return selected
+
+    def get_coeff(self):
+        return self._coeff
+
+    def get_centers(self):
+        return self._centers
+
+    def predict_batch(self, x_pred, chunk_size=PREDICT_CHUNK):
+        """
+        predicts the values of many points at once, the points are processed in chunks to bound the memory usage
+        :param x_pred: matrix of input values (m x k)
+        :param chunk_size: number of points per chunk
+        :return: array of m result values
+        """
+        x_pred = np.asarray(x_pred, dtype=float).reshape((-1, self._k))
+        fx = np.empty(x_pred.shape[0])
+        for i in range(0, x_pred.shape[0], chunk_size):
+            if self._rbf in COMPACT_RBFS:
+                fx[i:i + chunk_size] = self._predict_sparse(x_pred[i:i + chunk_size])
+                continue
+            radial = cdist(x_pred[i:i + chunk_size], self._centers)
+            fx[i:i + chunk_size] = self._rbf(self._rbf_const, radial) @ self._coeff
+        return fx
+
+    def _predict_sparse(self, x_pred):
+        """
+        :param x_pred: matrix of input values (m x k)
+        :return: array of m result values, only the centers within the support radius are used
+        """
+        neighbors = self._center_tree.query_ball_point(x_pred, self._rbf_const)
+        rows = np.repeat(np.arange(0, x_pred.shape[0]), [len(nb) for nb in neighbors])
+        cols = np.concatenate([np.array(nb, dtype=int) for nb in neighbors])
+        vals = self._rbf(self._rbf_const, np.linalg.norm(x_pred[rows] - self._centers[cols], axis=1)) * self._coeff[cols]
+        return np.bincount(rows, weights=vals, minlength=x_pred.shape[0])
+
+# the rbf functions work on scalars and on numpy arrays of radii
 
 def lin_rbf(a, r):
     return r
@@ -109,10 +298,20 @@ def cubic_rbf(a, r):
     return r**3
 
 def gaus_rbf(a, r):
-    return math.e**(-((a*r)**2))
+    return np.exp(-((a*r)**2))
 
 def multi_quad_rbf(a, r):
-    return math.sqrt(1 + (a * r) ** 2)
+    return np.sqrt(1 + (a * r) ** 2)
 
 def inv_multi_quad_rbf(a, r):
     return (1+r**2)**(a/2)
+
+def wendland_rbf(a, r):
+    # wendland c2 function with support radius a, positive definite for up to three inputs
+    r_rel = np.minimum(r / a, 1.)
+    return (1 - r_rel)**4 * (4 * r_rel + 1)
+
+# rbfs with positive definite interpolation matrix (cholesky solve)
+POS_DEF_RBFS = (gaus_rbf, inv_multi_quad_rbf)
+# rbfs with compact support (sparse interpolation matrix)
+COMPACT_RBFS = (wendland_rbf,)
@@ -0,0 +1,121 @@
+__author__ = "Juri Bieler"
+__version__ = "0.0.1"
+__email__ = "juribieler@gmail.com"
+__status__ = "Development"
+
+# ==============================================================================
+# description     :n-dimensional low-rank (inducing point) Kriging for large sample counts
+# date            :2018-07-23
+# version         :0.01
+# notes           :
+# python_version  :3.6
+# ==============================================================================
+
+from mylibs.batch_predictor import PREDICT_CHUNK
+from mylibs.kriging_base import KrigingBase
+
+import numpy as np
+from scipy.linalg import lapack
+from scipy.linalg import cho_solve
+
+VERBOSE = False
+# jitter on the diagonal of the inducing point correlation matrix
+JITTER = 1e-10
+
+
+class SparseKriging(KrigingBase):
+
+    def __init__(self, known_in, known_val, inducing_count=100, nugget=1e-6):
+        """
+        Kriging with a low rank (nystroem) approximation of the correlation matrix built from m inducing points,
+        training costs O(n * m^2) and prediction O(m) per point
+        :param known_in: list of lists with input sample points
+        :param known_val: list of results for the known_in
+        :param inducing_count: number of inducing points m (picked as space filling subset of known_in)
+        :param nugget: regularization (noise) of the low rank model, relative to the process variance
+        """
+        KrigingBase.__init__(self, known_in, known_val)
+        self._nugget = nugget
+        self._inducing = self._known_in[select_inducing(self._known_in, inducing_count)]
+        self._m = self._inducing.shape[0]
+        # A^-1 K_mn (y - 1 * mu), the weights of the inducing point correlations in predict
+        self._weights = None
+
+    def _calc_model(self):
+        """
+        Q = K_nm K_mm^-1 K_mn + nugget * I is handled with the woodbury identity
+        Q^-1 = (I - K_nm A^-1 K_mn) / nugget with A = nugget * K_mm + K_mn K_nm
+        :return: True if no errors
+        """
+        self._mu = None
+        self._weights = None
+        cor_mm = calc_cormat(self._inducing, self._inducing, self._theta, self._p)
+        cor_mm[np.diag_indices(self._m)] += JITTER
+        cor_nm = calc_cormat(self._known_in, self._inducing, self._theta, self._p)
+        chol_mm, info_mm = lapack.dpotrf(cor_mm, lower=1, clean=1)
+        chol_a, info_a = lapack.dpotrf(self._nugget * cor_mm + cor_nm.T @ cor_nm, lower=1, clean=1)
+        if info_mm != 0 or info_a != 0:
+            if VERBOSE:
+                print('ERROR: could not calc cholesky factorization of the low rank model')
+            return False
+        one = np.ones((self._n, 1)).flatten()
+        rhs = np.column_stack((one, self._known_val))
+        # Q^-1 @ [1, y]
+        inv_rhs = (rhs - cor_nm @ cho_solve((chol_a, True), cor_nm.T @ rhs, check_finite=False)) / self._nugget
+        self._mu = np.sum(inv_rhs[:, 1]) / np.sum(inv_rhs[:, 0])
+        resid = self._known_val - one * self._mu
+        self._sigma_sqr = (resid @ (inv_rhs[:, 1] - self._mu * inv_rhs[:, 0])) / self._n
+        self._ln_det_cor_mat = 2. * np.sum(np.log(np.diag(chol_a))) - 2. * np.sum(np.log(np.diag(chol_mm))) \
+            + (self._n - self._m) * np.log(self._nugget)
+        self._weights = cho_solve((chol_a, True), cor_nm.T @ resid, check_finite=False)
+        return True
+
+    def predict_batch(self, x_pred, chunk_size=PREDICT_CHUNK):
+        """
+        predicts the values of many points at once, every point only correlates with the m inducing points
+        :param x_pred: matrix of input values
+        :param chunk_size: number of points per chunk
+        :return: array of result values
+        """
+        self._check_model()
+        x_pred = np.asarray(x_pred, dtype=float).reshape((-1, self._k))
+        fx = np.empty(x_pred.shape[0])
+        for i in range(0, x_pred.shape[0], chunk_size):
+            fx[i:i + chunk_size] = self._mu + calc_cormat(x_pred[i:i + chunk_size], self._inducing, self._theta, self._p) @ self._weights
+        return fx
+
+    def get_inducing(self):
+        return self._inducing
+
+
+def calc_cormat(x_a, x_b, theta, p):
+    """
+    :param x_a: matrix of points (a x k)
+    :param x_b: matrix of points (b x k)
+    :return: kriging correlation matrix between x_a and x_b (a x b)
+    """
+    if np.all(p == 2.):
+        # squared distance of the theta scaled inputs (BLAS matmul, no a x b x k distance tensor)
+        scaled_a = x_a * np.sqrt(theta)
+        scaled_b = x_b * np.sqrt(theta)
+        dist_sum = np.sum(scaled_a ** 2, axis=1)[:, np.newaxis] + np.sum(scaled_b ** 2, axis=1)[np.newaxis, :] \
+            - 2. * (scaled_a @ scaled_b.T)
+        return np.exp(-np.maximum(dist_sum, 0.))
+    dist = np.abs(x_a[:, np.newaxis, :] - x_b[np.newaxis, :, :])
+    return np.exp(-((dist ** p) @ theta))
+
+
+def select_inducing(known_in, count):
+    """
+    space filling subset by greedy maximin selection (farthest point first), starting next to the center
+    :param known_in: matrix of sample points
+    :param count: number of points to select
+    :return: list of indices into known_in
+    """
+    count = min(count, known_in.shape[0])
+    indices = [int(np.argmin(np.sum((known_in - known_in.mean(axis=0)) ** 2, axis=1)))]
+    min_dist = np.sum((known_in - known_in[indices[0]]) ** 2, axis=1)
+    for i in range(1, count):
+        indices.append(int(np.argmax(min_dist)))
+        min_dist = np.minimum(min_dist, np.sum((known_in - known_in[indices[-1]]) ** 2, axis=1))
+    return indices
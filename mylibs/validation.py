@@ -20,13 +20,17 @@ class Validation:
     def __init__(self):
         pass
 
-    def calc_deviation(self, params, values, surro_func):
+    def calc_deviation(self, params, values, surro_func, batch_func=None):
         """
         :param list of entries for fem grid calculation
         :param values: list of results of params
         :param surro_func: pointer to the surrogates predict function
+        :param batch_func: optional pointer to a predict function that takes all params at once (like Kriging.predict_batch)
         :return: the deviation of a matrix with known solutions to the surrogate solution
         """
+        if batch_func is not None:
+            avg_deviation = np.mean(np.abs(np.array(values) - batch_func(np.array(params))))
+            return avg_deviation / np.array(values).mean()
         count = 0
         sum_deviation = 0
         # sample_indices = np.array([known_x_i, known_y_i]).T.tolist()
@@ -109,7 +113,7 @@ class Validation:
             sum += (res - res2)**2.
         return math.sqrt(sum / len(known_x))
 
-    def run_full_analysis(self, params, values, known_x, known_fx, vali_x, vali_fx, surro_func, surro_class, update_params=None):
+    def run_full_analysis(self, params, values, known_x, known_fx, vali_x, vali_fx, surro_func, surro_class, update_params=None, batch_func=None):
         """
         runs all validation techniques above
         :param params: list of entries for fem grid calculation
@@ -121,10 +125,11 @@ class Validation:
         :param surro_func: pointer to the surrogates predict function
         :param surro_class: class of the used surrogate
         :param update_params: parameters to pass to surrogate on fitting
+        :param batch_func: optional pointer to a predict function that takes all params at once
         :return:
         """
         res = ValidationResults()
-        res.deviation = self.calc_deviation(params, values, surro_func)
+        res.deviation = self.calc_deviation(params, values, surro_func, batch_func=batch_func)
         res.rmse = self.calc_rmse(vali_x, vali_fx, surro_func)
         res.mae = self.calc_mae(vali_x, vali_fx, surro_func)
         res.rae = self.calc_rae(vali_x, vali_fx, surro_func)
@@ -105,14 +105,18 @@ class PlotHelper:
             #print(str(angle))
             plt.pause(.001)
 
-    def plot_function_3d(self, f, fx, fy, label, color='b', scale=[1., 1., 1.], offset=[0., 0., 0.]):
-        fz = np.zeros((len(fy), len(fx)))
-        for iX in range(0, len(fx)):
-            for iY in range(0, len(fy)):
-                coords = [fx[iX], fy[iY]]
-                fz[iY][iX] = f(coords)
-
+    def plot_function_3d(self, f, fx, fy, label, color='b', scale=[1., 1., 1.], offset=[0., 0., 0.], batch=False):
         plotX, plotY = np.meshgrid(fx, fy)
+        if batch:
+            # f takes a matrix with one point per row and returns all values at once
+            fz = np.asarray(f(np.array([plotX.flatten(), plotY.flatten()]).T)).reshape(plotX.shape)
+        else:
+            fz = np.zeros((len(fy), len(fx)))
+            for iX in range(0, len(fx)):
+                for iY in range(0, len(fy)):
+                    coords = [fx[iX], fy[iY]]
+                    fz[iY][iX] = f(coords)
+
         surf = self.ax.plot_wireframe((plotX * scale[0])+offset[0],
                                       (plotY * scale[1])+offset[1],
                                       (fz * scale[2])+offset[2],
@@ -22,7 +22,7 @@ from myutils.plot_helper import PlotHelper
 
 
 def run_analysis():
-    surro_methods = [SURRO_POLYNOM]  # SURRO_KRIGING, SURRO_RBF, SURRO_POLYNOM, SURRO_PYKRIGING, SURRO_RBF_SCIPY
+    surro_methods = [SURRO_POLYNOM]  # SURRO_KRIGING, SURRO_RBF, SURRO_POLYNOM, SURRO_PYKRIGING, SURRO_RBF_SCIPY, SURRO_SPARSE_KRIGING, SURRO_GRID_KRIGING, SURRO_CG_KRIGING, SURRO_PU_RBF
     sample_methods = [SAMPLE_STRUCTURE, SAMPLE_LATIN, SAMPLE_HALTON]  # SAMPLE_LATIN, SAMPLE_HALTON
     sample_point_count = list(range(3, 30+1))
     use_abaqus = True
@@ -70,7 +70,12 @@ class WingStructureSurro(ExplicitComponent):
         self.add_output('stress', val=1e8)#, ref=1e8)
         self.add_output('weight', val=100.)#, ref=100)
 
-        self.declare_partials('*', '*', method='fd')
+        # the stress partials are analytic if the surrogate provides gradients, the weight comes from the fem model
+        if hasattr(self.surro, 'predict_gradient'):
+            self.declare_partials('stress', '*')
+        else:
+            self.declare_partials('stress', '*', method='fd')
+        self.declare_partials('weight', '*', method='fd')
         self.executionCounter = 0
         self.timer = TimeTrack()
 
@@ -113,6 +118,29 @@ class WingStructureSurro(ExplicitComponent):
         print('#{:d}: {:0.10f}({:d}), {:0.10f} -> {:0.10f}, {:0.10f}'.format(self.executionCounter, ribs, ribs_int, shell, stress, weight))
         print('#{:d}: {:0.10f}, {:0.10f} -> {:0.10f}, {:0.10f}'.format(self.executionCounter, inputs['ribs'][0], inputs['shell'][0], outputs['stress'][0], outputs['weight'][0]))
 
+    def compute_partials(self, inputs, partials):
+        if not hasattr(self.surro, 'predict_gradient'):
+            return
+        ribs = (inputs['ribs'][0] * scale_rib) + offset_rib
+        shell = (inputs['shell'][0] * scale_shell) + offset_shell
+        grad = self.surro.predict_gradient([ribs, shell])
+        partials['stress', 'ribs'] = grad[0] * scale_rib / scale_stress
+        partials['stress', 'shell'] = grad[1] * scale_shell / scale_stress
+
+
+class RibConstraint(ExplicitComponent):
+    """
+    con1 = fractional part of the (unscaled) rib count, int() can not be complex stepped so the partials are fd
+    """
+
+    def setup(self):
+        self.add_input('ribs', val=0.)
+        self.add_output('con1', val=0.)
+        self.declare_partials('con1', 'ribs', method='fd')
+
+    def compute(self, inputs, outputs):
+        outputs['con1'] = (inputs['ribs'] * scale_rib) - int(inputs['ribs'][0] * scale_rib)
+
 
 def write_mdao_log(out_str):
     out_str = out_str.replace('[', '')
@@ -166,7 +194,7 @@ def run_open_mdao():
     # constraint
     print('constrain stress: ' + str((max_shear_strength - offset_stress) / scale_stress))
     model.add_constraint('wing.stress', upper=(max_shear_strength - offset_stress) / scale_stress)
-    model.add_subsystem('con_cmp1', ExecComp('con1 = (ribs * '+str(scale_rib)+') - int(ribs[0] * '+str(scale_rib)+')'))
+    model.add_subsystem('con_cmp1', RibConstraint())
     model.add_constraint('con_cmp1.con1', upper=.5)
 
     prob = Problem(model)
@@ -187,7 +215,9 @@ def run_open_mdao():
 
     prob.setup()
     prob.set_solver_print(level=0)
-    prob.model.approx_totals()
+    # the totals are only assembled from the partials if the surrogate provides analytic stress gradients
+    if not hasattr(prob.model.wing.surro, 'predict_gradient'):
+        prob.model.approx_totals()
     prob.setup(check=True, mode='fwd')
     prob.run_driver()
 
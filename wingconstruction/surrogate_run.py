@@ -12,7 +12,6 @@ __status__ = "Development"
 
 import sys
 import os
-from scipy.optimize import minimize
 import numpy as np
 from scipy import optimize
 
@@ -24,7 +23,13 @@ from wingconstruction.multi_run import MultiRun
 from myutils.time_track import TimeTrack
 from myutils.plot_helper import PlotHelper
 from mylibs.kriging import Kriging
+from mylibs.sparse_kriging import SparseKriging
+from mylibs.grid_kriging import GridKriging
+from mylibs.grid_kriging import detect_grid
+from mylibs.cg_kriging import CGKriging
+from mylibs.hyper_cache import HyperCache
 from mylibs.rbf import RBF
+from mylibs.pu_rbf import PURBF
 from mylibs.polynomial import Polynomial
 from mylibs.interface.rbf_scipy import RBFscipy
 from mylibs.latin_hyper_cube import LatinHyperCube
@@ -76,6 +81,8 @@ class Surrogate:
         self.scale_shell = 1.
         self.update_params = None
         self.surro_class = None
+        # optimized kriging parameters of all runs, shared by all Surrogate instances through the file
+        self.hyper_cache = HyperCache(Constants().WORKING_DIR + '/kriging_hyper_cache.json')
 
         self.multi = MultiRun(use_calcu=True, use_aba=True, non_liner=False, force_recalc=force_recalc)
         self.results = SurroResults()
@@ -98,16 +105,22 @@ class Surrogate:
             return self.results, None
         self.run_validation_points()
         for i in range(0, sequential_runs + 1):
+            added = 0
             if self.results.optimum_weight > 0.:
                 self.known_params = np.append(self.known_params,
                                               [[self.results.optimum_rib, self.results.optimum_shell]], axis=0)
                 self._generate_scaled_sampling_points()
+                added = 1
 
             self.run_fem_calculation()
 
             fit_time = TimeTrack('FitTime')
             fit_time.tic()
-            if surro_type == SURRO_POLYNOM and auto_fit:
+            if surro_type == SURRO_KRIGING and added > 0:
+                # extend the existing model, it only gets optimized again if the likelihood drifts
+                self.surro.add_points(self.known_params_s[-added:], self.known_stress[-added:])
+                suc = True
+            elif surro_type == SURRO_POLYNOM and auto_fit:
                 suc = self.auto_fit_poly()
             elif surro_type == SURRO_RBF and auto_fit:
                 suc = self.auto_fit_rbf(params=params)
@@ -146,25 +159,20 @@ class Surrogate:
     def auto_fit_rbf(self, params=[]):
         """
         auto trains rbf-surrogate
-        :param params: additional parameter, if a rbf other than gaus should be used (see rbf.py)
+        :param params: additional parameter, params[0] (the former start value of a) is ignored, the leave-one-out
+        search covers the whole range of a, params[1] is the rbf function if other than gaus (see rbf.py),
+        a third one is the residual tolerance of a compact model (see RBF.fit_greedy)
         :return: True if no errors
         """
         rbf_func = 'gaus' # 'gaus' 'multi-quadratic'
-        init_a = 1.
-        if len(params) == 2:
-            init_a = params[0]
+        if len(params) >= 2:
             rbf_func = params[1]
-        res = minimize(self._opti_rbf, init_a, args=rbf_func, method='SLSQP', tol=1e-8,
-                       options={'disp': False, 'maxiter': 999}, bounds=[(0.01, 5.)])
-        self.results.opti_params = [res.x[0], rbf_func]
-        self.train_model(SURRO_RBF, [res.x[0], rbf_func])
+        # the leave-one-out error of the samples is known in closed form, no validation points needed
+        best_a = RBF(self.known_params_s, self.known_stress).optimize(rbf_func, bounds=(0.01, 5.))
+        self.results.opti_params = [best_a, rbf_func]
+        self.train_model(SURRO_RBF, [best_a, rbf_func] + list(params[2:]))
         return True
 
-    def _opti_rbf(self, a, rbf_func):
-        self.train_model(SURRO_RBF, [a, rbf_func])
-        self.run_validation(full_validation=False)
-        return self.results.vali_results.rmse / max_shear_strength
-
     def prepare(self, force_recalc=False):
         """
         initializes fem data and scaling
@@ -280,11 +288,11 @@ class Surrogate:
         if surro_type == SURRO_KRIGING:
             self.surro_class = Kriging
             self.surro = Kriging(self.known_params_s, self.known_stress)
-            # prev stored results:
-            self.surro.update_param([0.002261264770141511, 277826.21903867245], [1.8766170168043503, 1.9959876593551822])
             print('starting Likelihood optimization')
             opti_algo = 'grid'  # 'grid', 'basin'
-            self.surro.optimize(opti_algo=opti_algo, record_data=True)
+            # optimized parameters of earlier runs (same or similar sample plans) are reused
+            cache_scaling = [self.offset_rib, self.scale_rib, self.offset_shell, self.scale_shell]
+            self.surro.optimize(opti_algo=opti_algo, record_data=True, cache=self.hyper_cache, cache_scaling=cache_scaling)
             if self.show_plots:
                 pltLike = self.surro.plot_likelihoods(fancy=FANCY_PLOT, pgf=self.pgf, opti_path=np.array(self.surro.records))
                 pltLike.save(Constants().PLOT_PATH + 'wingSurroLikely' + opti_algo + '.pdf')
@@ -294,6 +302,25 @@ class Surrogate:
                 #print('@theta2 = ' + str(self.surro.get_theta()[1]))
                 #print('@p1 = ' + str(self.surro.get_p()[0]))
                 #print('@p2 = ' + str(self.surro.get_p()[1]))
+        elif surro_type == SURRO_SPARSE_KRIGING:
+            self.surro_class = SparseKriging
+            self.surro = SparseKriging(self.known_params_s, self.known_stress)
+            print('starting Likelihood optimization')
+            self.surro.optimize(opti_algo='adaptive')
+        elif surro_type == SURRO_GRID_KRIGING:
+            if detect_grid(self.known_params_s) is None:
+                print('GridKriging needs a full tensor grid as sample plan (use SAMPLE_STRUCTURE)')
+                self.results.errorStr = 'GridKriging needs a full tensor grid as sample plan'
+                return False
+            self.surro_class = GridKriging
+            self.surro = GridKriging(self.known_params_s, self.known_stress)
+            print('starting Likelihood optimization')
+            self.surro.optimize(opti_algo='grid')
+        elif surro_type == SURRO_CG_KRIGING:
+            self.surro_class = CGKriging
+            self.surro = CGKriging(self.known_params_s, self.known_stress)
+            print('starting Likelihood optimization')
+            self.surro.optimize(opti_algo='adaptive')
         elif surro_type == SURRO_RBF:
             self.surro_class = RBF
             self.surro = RBF(self.known_params_s, self.known_stress)
@@ -303,11 +330,26 @@ class Surrogate:
                 a = params[0]
                 if len(params) > 1:
                     rbf_func = params[1]
-            self.surro.update_param(a, rbf_func)
+            if len(params) > 2:
+                # compact model with only as many centers as needed for the residual tolerance params[2]
+                self.surro.fit_greedy(a, rbf_func, tol=params[2])
+            else:
+                self.surro.update_param(a, rbf_func)
             self.update_params = [a, rbf_func]
             #if self.show_plots:
             #    print('coeff1 = ' + str(self.surro.get_coeff()[0]))
             #    print('coeff2 = ' + str(self.surro.get_coeff()[1]))
+        elif surro_type == SURRO_PU_RBF:
+            self.surro_class = PURBF
+            self.surro = PURBF(self.known_params_s, self.known_stress)
+            a = 1.5
+            rbf_func = 'gaus'
+            if params != []:
+                a = params[0]
+                if len(params) > 1:
+                    rbf_func = params[1]
+            self.surro.update_param(a, rbf_func)
+            self.update_params = [a, rbf_func]
         elif surro_type == SURRO_POLYNOM:
             self.surro_class = Polynomial
             self.surro = Polynomial(self.known_params_s, self.known_stress)
@@ -367,6 +409,8 @@ class Surrogate:
         ##################################################
         # validate
         vali = Validation()
+        # surrogates with batch prediction evaluate the whole fem grid at once
+        batch_func = getattr(self.surro, 'predict_batch', None)
         if full_validation:
             p_x, p_y = np.meshgrid(self.ribs, self.shell)
             params = np.array([p_x.flatten(), p_y.flatten()]).T
@@ -377,7 +421,8 @@ class Surrogate:
             vali_r = vali.run_full_analysis(params_s, values,
                                             self.known_params_s, self.known_stress,
                                             self.vali_params_s, self.vali_values,
-                                            self.surro.predict, self.surro_class, update_params=self.update_params)
+                                            self.surro.predict, self.surro_class, update_params=self.update_params,
+                                            batch_func=batch_func)
             self.results.vali_results = vali_r
         else:
             rmse = vali.calc_rmse(self.vali_params_s, self.vali_values, self.surro.predict)
@@ -385,12 +430,17 @@ class Surrogate:
             self.results.vali_results.mae = vali.calc_mae(self.vali_params_s, self.vali_values, self.surro.predict)
         if self.show_plots and full_validation:
             deri_plot = PlotHelper(['Rippen', 'Blechdicke in mm'], fancy=FANCY_PLOT, pgf=self.pgf)
-            dev = np.zeros(self.stress.shape)
-            for xi in range(0, len(self.ribs_s)):
-                for yi in range(0, len(self.shell_s)):
-                    devi = (abs(self.stress[yi][xi] - self.surro.predict([self.ribs_s[xi], self.shell_s[yi]])) / np.array(
-                        self.stress).mean()) * 100.
-                    dev[yi][xi] = devi
+            if batch_func is not None:
+                p_x, p_y = np.meshgrid(self.ribs_s, self.shell_s)
+                pred = batch_func(np.array([p_x.flatten(), p_y.flatten()]).T).reshape(self.stress.shape)
+                dev = (np.abs(self.stress - pred) / np.array(self.stress).mean()) * 100.
+            else:
+                dev = np.zeros(self.stress.shape)
+                for xi in range(0, len(self.ribs_s)):
+                    for yi in range(0, len(self.shell_s)):
+                        devi = (abs(self.stress[yi][xi] - self.surro.predict([self.ribs_s[xi], self.shell_s[yi]])) / np.array(
+                            self.stress).mean()) * 100.
+                        dev[yi][xi] = devi
             pcol = deri_plot.ax.pcolor(self.ribs, np.array(self.shell) * 1000, dev, cmap='YlOrRd', alpha=0.7)
             pcol.set_clim(0, 5.)
             cbar = deri_plot.fig.colorbar(pcol)
@@ -411,6 +461,10 @@ class Surrogate:
         stress_val = surro_inst.predict([rib_num, shell_thick])
         return stress_val - max_shear_strength
 
+    @staticmethod
+    def shell_predict_deriv(shell_thick, surro_inst, rib_num):
+        return surro_inst.predict_gradient([rib_num, shell_thick])[1]
+
     def optimize(self):
         """
         runs optimizaiton on the surrogate model
@@ -424,6 +478,8 @@ class Surrogate:
         opti_weights = []
         used_ribs = np.array(range(range_rib[0], range_rib[1] + 1))
         used_ribs_s = (used_ribs - self.offset_rib) / self.scale_rib
+        # surrogates with analytic gradients get real newton steps instead of the secant method
+        fprime = self.shell_predict_deriv if hasattr(self.surro, 'predict_gradient') else None
         for i in range(0, len(used_ribs_s)):
             # SLSQP: proplem; find local min not glob. depending on init-vals
             init_guess = (min(self.known_params_s[:, 1]) + max(self.known_params_s[:, 1])) / 2
@@ -431,7 +487,7 @@ class Surrogate:
             # res = minimize(shell_predict, init_guess, args=[krig, ribs[i]], method='SLSQP', tol=1e-6, options={'disp': True, 'maxiter': 99999}, bounds=bnds)
             # opti_shell.append(res.x[0])
             try:
-                root_s = optimize.newton(self.shell_predict, init_guess, args=[self.surro, used_ribs_s[i]])
+                root_s = optimize.newton(self.shell_predict, init_guess, fprime=fprime, args=[self.surro, used_ribs_s[i]])
                 root = (root_s * self.scale_shell) + self.offset_shell
                 root_stress = self.surro.predict([used_ribs_s[i], root_s])
                 if root_stress < max_shear_strength * 1.05: #this check is needed if the surrogate does not cross the max stress at all at this ribnumber
@@ -513,10 +569,13 @@ class Surrogate:
         surro_short_name = SURRO_NAMES[self.surro_type][:3]
         if len(SURRO_NAMES[self.surro_type]) > 3:
             surro_short_name += '.'
-        surro_plot = plot3d.plot_function_3d(self.surro.predict, ribs_sample, shell_sample,
+        batch_func = getattr(self.surro, 'predict_batch', None)
+        surro_plot = plot3d.plot_function_3d(batch_func if batch_func is not None else self.surro.predict,
+                                             ribs_sample, shell_sample,
                                              r'$\widehat{f}_{' + surro_short_name + '}$', color='b',
                                              scale=[self.scale_rib, self.scale_shell * 1000., 1.],
-                                             offset=[self.offset_rib, self.offset_shell * 1000, 0.])
+                                             offset=[self.offset_rib, self.offset_shell * 1000, 0.],
+                                             batch=batch_func is not None)
         samplePoints = plot3d.ax.plot(self.known_params[:, 0], self.known_params[:, 1] * 1000., self.known_stress, 'bo',
                                       label=u'Stützstellen')
 
@@ -584,7 +643,7 @@ if __name__ == '__main__':
     PGF = False
     SHOW_PLOT = True
     # SAMPLE_LATIN, SAMPLE_HALTON, SAMPLE_STRUCTURE, SAMPLE_OPTI_LATIN_HYPER
-    # SURRO_KRIGING, SURRO_RBF, SURRO_POLYNOM, SURRO_PYKRIGING, SURRO_RBF_SCIPY
+    # SURRO_KRIGING, SURRO_RBF, SURRO_POLYNOM, SURRO_PYKRIGING, SURRO_RBF_SCIPY, SURRO_SPARSE_KRIGING, SURRO_GRID_KRIGING, SURRO_CG_KRIGING, SURRO_PU_RBF
     if False:
         sur = Surrogate(use_abaqus=True, pgf=PGF, show_plots=SHOW_PLOT, scale_it=True)
         res, _ = sur.auto_run(SAMPLE_LATIN, 14, SURRO_KRIGING, run_validation=False, auto_fit=False, sequential_runs=0, params=[1.,'cubic']) # 'gaus' 'multi-quadratic'
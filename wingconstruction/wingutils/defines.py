@@ -45,9 +45,13 @@ SAMPLE_HALTON = 1
 SAMPLE_STRUCTURE = 2
 SAMPLE_OPTI_LATIN_HYPER = 3
 
-SURRO_NAMES = ['Kriging', 'RBF', 'Polynom', 'PyKriging', 'RBFscipy']
+SURRO_NAMES = ['Kriging', 'RBF', 'Polynom', 'PyKriging', 'RBFscipy', 'SparseKriging', 'GridKriging', 'CGKriging', 'PURBF']
 SURRO_KRIGING = 0
 SURRO_RBF = 1
 SURRO_POLYNOM = 2
 SURRO_PYKRIGING = 3
-SURRO_RBF_SCIPY = 4
\ No newline at end of file
+SURRO_RBF_SCIPY = 4
+SURRO_SPARSE_KRIGING = 5
+SURRO_GRID_KRIGING = 6
+SURRO_CG_KRIGING = 7
+SURRO_PU_RBF = 8